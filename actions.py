@@ -2,10 +2,15 @@ from dataclasses import dataclass
 from datetime import datetime
 from typing import Dict, Optional
 
+from conf import SEARCH_PAGE_MAX, SEARCH_PAGE_SIZE, UPDATES_PAGE_SIZE, UPDATES_PAGE_MAX
 from lib import db
 from lib.connection import Connection
+from lib.dispatch import action
+from lib.receipts import read_receipts
 from utils import crypt
 from utils.decorators import protected
+from utils.exceptions import BusyException, CommitException
+from utils.serializers import compact_updates, serialize_chats, serialize_messages
 
 
 @dataclass
@@ -16,7 +21,8 @@ class Response:
     send_now: bool = True
 
 
-def login(data: Dict, conn) -> Response:
+@action({"username": str, "password": str}, rate=0.5, burst=5)
+async def login(data: Dict, conn) -> Response:
     username: str = data.get("username", "")
     password: str = data.get("password", "")
 
@@ -29,12 +35,15 @@ def login(data: Dict, conn) -> Response:
     if errors:
         return Response(False, errors)
 
-    user = db.users.get(username=username)
+    user = await db.users.get(username=username)
     if not user:
         errors["message"] = "Username or Password is invalid"
         return Response(False, errors)
 
-    is_password_correct = crypt.check_password(password, user.password)
+    try:
+        is_password_correct = await crypt.check_password_async(password, user.password)
+    except BusyException as e:
+        return Response(False, {"message": e.message})
     if is_password_correct:
         tokens = crypt.create_tokens(user)
         return Response(True, tokens)
@@ -43,7 +52,8 @@ def login(data: Dict, conn) -> Response:
     return Response(False, errors)
 
 
-def sign_up(data: Dict, conn) -> Response:
+@action({"username": str, "password": str, "email": str, "avatar": str, "full_name": str}, rate=0.1, burst=3)
+async def sign_up(data: Dict, conn) -> Response:
     username: str = data.get("username", "")
     password: str = data.get("password", "")
     email: str = data.get("email", "")
@@ -59,7 +69,7 @@ def sign_up(data: Dict, conn) -> Response:
     if errors:
         return Response(False, errors)
 
-    user_exists = db.users.check_exists(username=username, email=email)
+    user_exists = await db.users.check_exists(username=username, email=email)
     if user_exists["username"]:
         errors["username"] = "User with this username already exists."
     if user_exists["email"]:
@@ -68,14 +78,18 @@ def sign_up(data: Dict, conn) -> Response:
         return Response(False, errors)
 
     user = db.User(**data)
-    user.password = crypt.hash_password(user.password)
-    user = db.users.create(user)
+    try:
+        user.password = await crypt.hash_password_async(user.password)
+    except BusyException as e:
+        return Response(False, {"message": e.message})
+    user = await db.users.create(user)
 
     tokens = crypt.create_tokens(user)
     return Response(True, tokens)
 
 
-def authenticate(data: Dict, conn: Connection) -> Response:
+@action({"access_token": str}, rate=1, burst=5)
+async def authenticate(data: Dict, conn: Connection) -> Response:
     access_token = data.get("access_token", "")
 
     payload = crypt.validate_access_token(access_token)
@@ -83,19 +97,20 @@ def authenticate(data: Dict, conn: Connection) -> Response:
         return Response(False, {"message": "Access token is no valid"})
 
     user_id = payload.get("sub")
-    user = db.users.get(id=user_id)
+    user = await db.users.get(id=user_id)
     if not user:
         return Response(False, {"message": "User not found"})
 
     conn.authenticate(user)
     return Response(True, {"message": "authenticated", "user": user.serialize()})
 
+@action({"username": str, "avatar": str, "full_name": str}, rate=1, burst=5)
 @protected
-def update_user(data, conn) -> Response:
+async def update_user(data, conn) -> Response:
     user = conn.user
 
     username = data.get("username")
-    if username != user.username and db.users.check_exists(username=username).get("username"):
+    if username != user.username and (await db.users.check_exists(username=username)).get("username"):
         return Response(False, {"username": "User with this username already exists"})
 
     updated_user = db.User(
@@ -105,21 +120,49 @@ def update_user(data, conn) -> Response:
         avatar=data.get("avatar", user.avatar),
         full_name=data.get("full_name", user.full_name)
     )
-    updated_user = db.users.update(user._id, updated_user)
+    updated_user = await db.users.update(user._id, updated_user)
     conn.authenticate(updated_user)
 
     return Response(True, {"user": updated_user.serialize()})
 
 
+@action({"q": str, "offset": int, "limit": int}, rate=5, burst=10, concurrency=64)
 @protected
-def search_users(data, conn) -> Response:
+async def search_users(data, conn) -> Response:
     query = data.get("q")
-    users = db.users.search(query)
+    offset = max(int(data.get("offset") or 0), 0)
+    limit = max(1, min(int(data.get("limit") or SEARCH_PAGE_SIZE), SEARCH_PAGE_MAX))
+
+    users, has_more = await db.users.search(query, offset=offset, limit=limit)
     serialized_users = [user.serialize() for user in users]
-    return Response(True, {"results": serialized_users})
+    return Response(True, {"results": serialized_users, "has_more": has_more})
+
+
+@action({"q": str, "chat_id": str, "cursor": str, "limit": int}, rate=2, burst=5, concurrency=32)
+@protected
+async def search_messages(data, conn: Connection) -> Response:
+    query = data.get("q")
+    chat_id = data.get("chat_id")
+    limit = max(1, min(int(data.get("limit") or SEARCH_PAGE_SIZE), SEARCH_PAGE_MAX))
+    user_id = str(conn.user._id) # type: ignore
+
+    if chat_id:
+        chat = await db.chats.get(chat_id)
+        if not chat or user_id not in (str(chat.user1), str(chat.user2)):
+            return Response(False, {"message": "chat not found"})
 
+    try:
+        hits, cursor = await db.message_search.search(user_id, query, chat_id=chat_id, cursor=data.get("cursor"), limit=limit)
+    except ValueError:
+        return Response(False, {"message": "invalid cursor"})
 
-def refresh_access_token(data, conn) -> Response:
+    messages_serialized = await serialize_messages([message for message, _ in hits])
+    results = [{"message": message, "snippet": snippet} for message, (_, snippet) in zip(messages_serialized, hits)]
+    return Response(True, {"results": results, "cursor": cursor})
+
+
+@action({"refresh_token": str}, rate=1, burst=5)
+async def refresh_access_token(data, conn) -> Response:
     refresh_token = data.get("refresh_token")
     access_token = crypt.refresh_access_token(refresh_token)
     if not access_token:
@@ -128,141 +171,163 @@ def refresh_access_token(data, conn) -> Response:
     return Response(True, {"access_token": access_token})
 
 
+@action()
 @protected
-def get_chats(data, conn) -> Response:
+async def get_chats(data, conn) -> Response:
     user = conn.user
-    chats = db.chats.get_user_chats(user._id)
-    chats_serialized = [chat.serialize(user) for chat in chats]
+    chats = await db.chats.get_user_chats(user._id)
+    chats_serialized = await serialize_chats(chats, user)
     return Response(True, {"results": chats_serialized})
 
 
+@action({"chat_id": str, "user_id": str, "text": str, "reply_to": str, "local_id": (str, int), "timestamp": float})
 @protected
-def new_message(data, conn) -> Response:
+async def new_message(data, conn) -> Response:
     chat_id = data.get("chat_id", "")
     chat = None
     if not chat_id:
         user_id = data.get("user_id")
-        chat = db.chats.check_exists(conn.user._id, user_id)
+        chat = await db.chats.check_exists(conn.user._id, user_id)
         if not chat:
             if not user_id:
                 return Response(False, {"message": "chat id or user id required"})
             chat = db.Chat(user1=conn.user._id, user2=user_id)
-            chat = db.chats.create(chat)
+            chat = await db.chats.create(chat)
         chat_id = str(chat._id)
     else:
-        chat = db.chats.get(chat_id)
+        chat = await db.chats.get(chat_id)
 
     text = data.get("text")
     reply_to = data.get("reply_to")
 
     local_id = data.get("local_id")
-    time = None
+    time = datetime.now()
     if local_id:
         timestamp = data.get("timestamp")
         time = datetime.fromtimestamp(timestamp)
 
-    message = db.Message(text=text, sender=conn.user._id, chat=chat_id, reply_to=reply_to)
-    if time:
-        message.time = time
-
-    message = db.messages.create(message)
-
-    message_serialized = message.serialize()
+    # the id is assigned up front, so the update can be built before the batched write
+    message = db.Message(text=text, sender=conn.user._id, chat=chat_id, reply_to=reply_to, time=time)
+    message_serialized = (await serialize_messages([message]))[0]
 
     data = {"message": message_serialized}
     if local_id:
         data["local_id"] = local_id
 
+    update = None
     if chat:
         update = db.Update(type="new_message", body=data, users=list(set([chat.user1, chat.user2])))
-        db.updates.create(update)
+    try:
+        await db.messages.create(message, update)
+    except CommitException as e:
+        # the only answer the sender gets, delivered frames are the success response
+        return Response(False, {"message": e.message, "stored": e.stored, "id": str(message._id), "local_id": local_id})
 
     return Response(True, {}, send_now=False)
 
 
+@action({"chat_id": str, "user_id": str, "last_message": str, "after": str, "around": str})
 @protected
-def get_messages(data, conn) -> Response:
+async def get_messages(data, conn) -> Response:
     chat = None
     chat_id = data.get("chat_id", "")
     last_message = data.get("last_message")
 
     if not chat_id:
         user_id = data.get("user_id")
-        chat = db.chats.check_exists(conn.user._id, user_id)
+        chat = await db.chats.check_exists(conn.user._id, user_id)
         if not chat:
             if not user_id:
                 return Response(False, {"message": "chat id or user id required"})
             chat = db.Chat(user1=conn.user._id, user2=user_id)
-            chat = db.chats.create(chat)
+            chat = await db.chats.create(chat)
         chat_id = str(chat._id)
 
     if not chat:
-        chat = db.chats.get(chat_id)
+        chat = await db.chats.get(chat_id)
         if not chat:
             return Response(False, {"message": "chat not found"})
 
-    messages, has_more = db.messages.get_chat_messages(chat_id, limit=30, last_message=last_message)
-    messages_serialized = [message.serialize() for message in messages]
-    return Response(True, {"results": messages_serialized, "chat": chat.serialize(conn.user), "has_more": has_more})
+    messages, has_more, has_newer = await db.messages.get_chat_messages(
+        chat_id, limit=30, before=last_message, after=data.get("after"), around=data.get("around")
+    )
+    messages_serialized = await serialize_messages(messages)
+    return Response(True, {"results": messages_serialized, "chat": await chat.serialize(conn.user), "has_more": has_more, "has_newer": has_newer})
 
 
+@action({"message_id": str, "chat_id": str})
 @protected
-def delete_message(data, conn: Connection) -> Response:
+async def delete_message(data, conn: Connection) -> Response:
     message_id = data.get("message_id")
-    message = db.messages.get(message_id)
+    message = await db.messages.get(message_id)
     if not message:
         return Response(False, {"message": "message not found"})
 
     if not conn.user or message.sender != str(conn.user._id):
         return Response(False, {"message": "permission error"})
 
-    chat = db.chats.get(id=message.chat)
+    chat = await db.chats.get(id=message.chat)
 
-    db.messages.delete(message_id)
+    await db.messages.delete(message_id, str(message.chat))
     if chat:
         update = db.Update(type="delete_message", body={"message_id": message_id, "chat_id": str(message.chat)}, users=list(set([chat.user1, chat.user2])))
-        db.updates.create(update)
+        await db.updates.create(update)
 
     return Response(True, {}, send_now=False)
 
 
+@action({"message_id": str, "chat_id": str, "text": str})
 @protected
-def edit_message(data, conn: Connection) -> Response:
+async def edit_message(data, conn: Connection) -> Response:
     message_id = data.get("message_id")
     text = data.get("text")
-    message = db.messages.get(message_id)
+    message = await db.messages.get(message_id)
     if not message:
         return Response(False, {"message": "message not found"})
 
     if not conn.user or message.sender != str(conn.user._id):
         return Response(False, {"message": "permission error"})
 
-    chat = db.chats.get(id=message.chat)
-    db.messages.update(message_id, {"text": text})
+    chat = await db.chats.get(id=message.chat)
+    await db.messages.update(message_id, {"text": text}, str(message.chat))
 
     if chat:
         update = db.Update(type="edit_message", body={"message_id": message_id, "text": text, "chat_id": str(message.chat)}, users=list(set([chat.user1, chat.user2])))
-        db.updates.create(update)
+        await db.updates.create(update)
 
     return Response(True, {}, send_now=False)
 
 
+@action({"message_id": str, "message_ids": [str], "chat_id": str, "up_to": str})
 @protected
-def read_message(data, conn: Connection) -> Response:
+async def read_message(data, conn: Connection) -> Response:
     message_id = data.get("message_id")
     message_ids = data.get("message_ids", []) # for multiple
     chat_id = data.get("chat_id")
+    up_to = data.get("up_to") # everything up to this message
+
+    if up_to:
+        message = await db.messages.get(up_to)
+        if not message:
+            return Response(False, {"message": "message not found"})
+        chat = await db.chats.get(message.chat)
+        user_id = str(conn.user._id) # type: ignore
+        if not chat or user_id not in (str(chat.user1), str(chat.user2)):
+            return Response(False, {"message": "permission error"})
+
+        read_receipts.mark(chat, user_id, message)
+        return Response(True, {"chat_id": str(message.chat), "up_to": up_to, "status": "read"})
 
     updated = False
     if message_id:
         message_ids.append(message_id)
-    updated = db.messages.update_many(message_ids, {"status": db.Message.Status.READ.value})
+    updated = await db.messages.update_many(message_ids, {"status": db.Message.Status.READ.value})
 
     user_to_notify = None
 
     if updated:
         user_to_notify = ""
-        chat = db.chats.get(chat_id)
+        chat = await db.chats.get(chat_id)
         if chat:
             if conn.user and str(chat.user1) == str(conn.user._id):
                 user_to_notify = chat.user2
@@ -271,18 +336,27 @@ def read_message(data, conn: Connection) -> Response:
 
             data = {"message_ids": message_ids, "chat_id": chat_id, "status": "read"}
             update = db.Update(type="read_message", body=data, users=[user_to_notify])
-            db.updates.create(update)
+            await db.updates.create(update)
 
     return Response(updated, {"message_ids": message_ids, "chat_id": chat_id, "status": "read"}, send_now=True)
 
 
+@action({"after_seq": int, "last_time": float, "limit": int}, rate=5, burst=10)
 @protected
-def get_updates(data, conn: Connection) -> Response:
+async def get_updates(data, conn: Connection) -> Response:
+    user_id = str(conn.user._id) # type: ignore
+    after_seq = data.get("after_seq")
     last_time = data.get("last_time")
     if last_time:
         last_time = datetime.fromtimestamp(last_time)
+    limit: Optional[int] = max(1, min(int(data.get("limit") or UPDATES_PAGE_SIZE), UPDATES_PAGE_MAX))
+    if after_seq is None and not data.get("limit"):
+        # clients from before seqs don't follow has_more, they still get everything after last_time
+        limit = None
 
-    updates = db.updates.get(user=str(conn.user._id), created_at=last_time) # type: ignore
+    updates, has_more = await db.updates.get(user=user_id, after_seq=after_seq, created_at=last_time, limit=limit)
+    # the cursor follows the raw log, compaction only changes what is sent
+    last_seq = updates[-1].seqs[user_id] if updates else after_seq
 
-    updates_serialized = [update.to_dict() for update in updates]
-    return Response(True, {"updates": updates_serialized})
+    updates_serialized = [update.to_dict(user_id) for update in compact_updates(updates)]
+    return Response(True, {"updates": updates_serialized, "has_more": has_more, "last_seq": last_seq})
@@ -0,0 +1,339 @@
+"""
+Websocket load test. Seeds a scratch database with users, chats and history,
+starts main.Server in a child process and drives simulated clients through:
+
+    connect         connect and authenticate every client
+    get_chats       one get_chats per client
+    get_messages    one get_messages per client, on one of its chats
+    new_message     every client sends at --rate for --duration seconds,
+                    latency is send to delivery at the other participant
+    reconnect       --storm of the clients drop at once, then reconnect,
+                    authenticate and catch up with get_updates
+
+and reports throughput and p50/p95/p99 per phase.
+
+    MONGO_DB=chat_bench python -m bench.load --clients 2000 --out load.json --compare previous.json
+
+Extra settings for the server go through --server-env, e.g. --server-env GROUP_COMMIT_WINDOW=0
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+from dataclasses import asdict
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+from bson.objectid import ObjectId
+
+from bench.report import compare, percentiles, save
+from conf import MONGO_DB
+from lib import db
+from lib.indexes import ensure_indexes
+from utils import crypt
+
+COLLECTIONS = ("users", "chats", "messages", "message_search", "updates", "counters", "read_marks")
+
+
+def _serve() -> None:
+    # child process: the environment was prepared by the parent before spawning
+    sys.stdout = open(os.devnull, "w")
+    import main
+    main.run_worker()
+
+
+class Bench:
+    """
+    Shared state of a run: messages in flight and the samples collected
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.in_flight: Dict[str, Tuple[float, str]] = {}
+        self.deliveries: List[float] = []
+        self.errors = 0
+
+    def delivered(self, frame: dict, user_id: str) -> None:
+        local_id = frame.get("data", {}).get("local_id")
+        sent = self.in_flight.get(local_id) if local_id else None
+        if sent and sent[1] != user_id:
+            self.deliveries.append((time.perf_counter() - sent[0]) * 1000)
+            del self.in_flight[local_id]
+
+
+class Client:
+    def __init__(self, bench: Bench, user_id: str, token: str, chats: List[str]) -> None:
+        self.bench = bench
+        self.user_id = user_id
+        self.token = token
+        self.chats = chats
+        self.last_seq = 0
+        self.sent = 0
+        self.ws = None
+        self._reader: Optional[asyncio.Task] = None
+        self._waiting: Dict[str, asyncio.Future] = {}
+
+    async def connect(self) -> None:
+        self.ws = await websockets.connect(self.bench.url, max_size=None, open_timeout=30)
+        self._reader = asyncio.create_task(self._read())
+        response = await self.request("authenticate", {"access_token": self.token})
+        if not response.get("success"):
+            raise RuntimeError(f"authenticate failed: {response}")
+
+    async def request(self, action: str, data: dict, timeout: float = 30) -> dict:
+        """
+        Send a request and wait for its response, one request per action at a time
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[action] = future
+        await self.ws.send(json.dumps({"action": action, "data": data}))
+        return await asyncio.wait_for(future, timeout)
+
+    async def send_message(self) -> None:
+        self.sent += 1
+        local_id = f"{self.user_id}-{self.sent}"
+        self.bench.in_flight[local_id] = (time.perf_counter(), self.user_id)
+        data = {"chat_id": random.choice(self.chats), "text": f"load test {self.sent}", "local_id": local_id, "timestamp": time.time()}
+        await self.ws.send(json.dumps({"action": "new_message", "data": data}))
+
+    def drop(self) -> None:
+        # like a network drop: no close handshake
+        self.ws.transport.abort()
+
+    async def close(self) -> None:
+        if self.ws:
+            await self.ws.close()
+        if self._reader:
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+    async def _read(self) -> None:
+        try:
+            async for raw in self.ws:
+                frame = json.loads(raw)
+                if "seq" in frame:
+                    self.last_seq = max(self.last_seq, frame["seq"] or 0)
+                    if frame["action"] == "new_message":
+                        self.bench.delivered(frame, self.user_id)
+                    continue
+                future = self._waiting.pop(frame.get("action"), None)
+                if future and not future.done():
+                    future.set_result(frame)
+        except websockets.ConnectionClosed:
+            pass
+
+
+def seed(args, rng: random.Random) -> List[Tuple[str, str, List[str]]]:
+    """
+    Insert users, chats and history straight into the database,
+    returns (user id, access token, chat ids) per client
+    """
+    users = [db.User(username=f"load{i}", email=f"load{i}@example.com", password="") for i in range(args.clients)]
+    for user in users:
+        user._id = ObjectId()
+    db.db.users.insert_many([asdict(user) for user in users])
+
+    chats_of: Dict[str, List[str]] = {str(user._id): [] for user in users}
+    chats, messages = [], []
+    for i, user in enumerate(users):
+        for step in range(1, args.chats_per_user // 2 + 1):
+            other = users[(i + step) % len(users)]
+            chat = db.Chat(user1=str(user._id), user2=str(other._id), _id=ObjectId())
+            chats.append(asdict(chat))
+            chats_of[chat.user1].append(str(chat._id))
+            chats_of[chat.user2].append(str(chat._id))
+            for n in range(args.history):
+                sender = rng.choice((chat.user1, chat.user2))
+                message = db.Message(chat=str(chat._id), text=f"history {n}", sender=sender)
+                messages.append({"_id": message._id, **message.to_dict()})
+    db.db.chats.insert_many(chats)
+    for offset in range(0, len(messages), 10000):
+        db.db.messages.insert_many(messages[offset:offset + 10000], ordered=False)
+
+    return [(str(user._id), crypt.create_tokens(user)["access"], chats_of[str(user._id)]) for user in users]
+
+
+async def timed(samples: List[float], bench: Bench, call) -> None:
+    started = time.perf_counter()
+    try:
+        response = await call
+        if isinstance(response, dict) and not response.get("success"):
+            bench.errors += 1
+            return
+    except Exception:
+        bench.errors += 1
+        return
+    samples.append((time.perf_counter() - started) * 1000)
+
+
+async def phase(name: str, bench: Bench, calls, concurrency: int) -> Dict:
+    """
+    Run the calls with at most `concurrency` in flight, timing each
+    """
+    samples: List[float] = []
+    errors = bench.errors
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(call):
+        async with slots:
+            await timed(samples, bench, call())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(call) for call in calls))
+    elapsed = time.perf_counter() - started
+    result = {**percentiles(samples), "errors": bench.errors - errors, "seconds": elapsed, "per_second": len(samples) / elapsed}
+    report(name, result)
+    return result
+
+
+async def message_phase(bench: Bench, clients: List[Client], args) -> Dict:
+    async def sender(client: Client):
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(random.expovariate(args.rate))
+            try:
+                await client.send_message()
+            except websockets.ConnectionClosed:
+                bench.errors += 1
+                return
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(client) for client in clients))
+    sent = sum(client.sent for client in clients)
+    # let the tail arrive
+    for _ in range(100):
+        if not bench.in_flight:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    result = {
+        **percentiles(bench.deliveries),
+        "sent": sent,
+        "lost": len(bench.in_flight),
+        "seconds": elapsed,
+        "per_second": len(bench.deliveries) / elapsed,
+    }
+    report("new_message", result)
+    return result
+
+
+def report(name: str, result: Dict) -> None:
+    if not result.get("count"):
+        print(f"{name:>14}  no samples  {result}")
+        return
+    print(f"{name:>14}  {result['count']:>7} ok  {result['per_second']:9.1f}/s  p50 {result['p50_ms']:8.2f}ms  "
+          f"p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  errors {result.get('errors', 0)}")
+
+
+async def drive(args, seeded, url: str) -> Dict[str, Dict]:
+    rng = random.Random(args.seed)
+    bench = Bench(url)
+    clients = [Client(bench, user_id, token, chats) for user_id, token, chats in seeded]
+
+    results = {}
+    results["connect"] = await phase("connect", bench, [client.connect for client in clients], args.concurrency)
+    connected = [client for client in clients if client.ws and client._reader and not client._reader.done()]
+    results["get_chats"] = await phase(
+        "get_chats", bench, [lambda c=client: c.request("get_chats", {}) for client in connected], args.concurrency
+    )
+    results["get_messages"] = await phase(
+        "get_messages", bench,
+        [lambda c=client: c.request("get_messages", {"chat_id": rng.choice(c.chats)}) for client in connected if client.chats],
+        args.concurrency,
+    )
+    results["new_message"] = await message_phase(bench, connected, args)
+
+    dropped = rng.sample(connected, int(len(connected) * args.storm))
+    for client in dropped:
+        client.drop()
+    await asyncio.sleep(0.5)
+
+    async def reconnect(client: Client):
+        await client.connect()
+        return await client.request("get_updates", {"after_seq": client.last_seq})
+
+    # all at once, no concurrency cap
+    results["reconnect"] = await phase("reconnect", bench, [lambda c=client: reconnect(c) for client in dropped], len(dropped) or 1)
+
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--chats-per-user", type=int, default=6)
+    parser.add_argument("--history", type=int, default=30, help="messages seeded per chat")
+    parser.add_argument("--concurrency", type=int, default=200, help="requests in flight during request phases")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of new_message traffic")
+    parser.add_argument("--storm", type=float, default=0.5, help="fraction of clients dropped and reconnected at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server", help="ws:// url of a server already running on the same database, instead of starting one")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="setting for the started server")
+    parser.add_argument("--keep", action="store_true", help="leave the seeded data in the database")
+    parser.add_argument("--force", action="store_true", help="allow running against the default database")
+    parser.add_argument("--out", help="write the results as json to this file")
+    parser.add_argument("--compare", help="json written by an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    if MONGO_DB == "chat" and not args.force:
+        raise SystemExit("set MONGO_DB to a scratch database, this benchmark writes and drops collections")
+    if any(db.db[name].estimated_document_count() for name in COLLECTIONS):
+        raise SystemExit(f"{MONGO_DB} is not empty, point MONGO_DB at an empty database")
+
+    ensure_indexes()
+    seeded = seed(args, random.Random(args.seed))
+
+    server = None
+    url = args.server
+    if not url:
+        port = free_port()
+        os.environ.update(dict(setting.split("=", 1) for setting in args.server_env))
+        os.environ["BIND_HOST"] = "127.0.0.1"
+        os.environ["BIND_PORT"] = str(port)
+        server = multiprocessing.get_context("spawn").Process(target=_serve, daemon=True)
+        server.start()
+        url = f"ws://127.0.0.1:{port}"
+
+    try:
+        asyncio.run(wait_for_server(url))
+        results = asyncio.run(drive(args, seeded, url))
+    finally:
+        if server:
+            server.terminate()
+            server.join()
+        if not args.keep:
+            for name in COLLECTIONS:
+                db.db.drop_collection(name)
+
+    if args.out:
+        save(args.out, "load", vars(args), results)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
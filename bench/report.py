@@ -0,0 +1,65 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    Summary of latency samples in milliseconds
+    """
+    if not samples:
+        return {"count": 0}
+    if len(samples) == 1:
+        samples = samples * 2
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples),
+        "p50_ms": cuts[49],
+        "p95_ms": cuts[94],
+        "p99_ms": cuts[98],
+        "max_ms": max(samples),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(path: str, benchmark: str, config: dict, results: dict) -> None:
+    report = {
+        "benchmark": benchmark,
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "config": config,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def compare(path: str, results: dict) -> None:
+    """
+    Print how each phase's percentiles moved against a saved report
+    """
+    with open(path) as f:
+        before = json.load(f)
+    print(f"\nagainst {path} (commit {before.get('commit')})")
+    for phase, now in results.items():
+        old = before["results"].get(phase)
+        if not old or not old.get("count") or not now.get("count"):
+            continue
+        moves = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            change = (now[key] - old[key]) / old[key] * 100 if old[key] else 0
+            moves.append(f"{key[:-3]} {old[key]:.2f} -> {now[key]:.2f}ms ({change:+.0f}%)")
+        print(f"{phase:>14}  " + "  ".join(moves))
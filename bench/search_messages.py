@@ -0,0 +1,150 @@
+"""
+Times search_messages on a synthetic corpus. Fills the configured database with
+users, chats and messages whose words follow a Zipf-like distribution, then runs
+batches of common word, rare word, two word, prefix and single chat queries.
+
+    MONGO_DB=chat_bench python -m bench.search_messages --messages 2000000 --out search.json
+
+Point MONGO_DB at a scratch database: the corpus is written with plain inserts,
+and dropped at the end unless --keep is given. --reuse skips generation and
+benchmarks, without dropping, a corpus kept by an earlier run
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from bson.objectid import ObjectId
+
+from bench.report import percentiles, save
+from conf import MONGO_DB
+from lib import db
+from lib.indexes import ensure_indexes
+from lib.search import message_keys
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa", "do", "gu", "be", "fi", "ho", "ja"]
+COLLECTIONS = ("users", "chats", "messages", "message_search")
+
+
+def vocabulary(size: int, rng: random.Random) -> List[str]:
+    words: Dict[str, None] = {}
+    while len(words) < size:
+        words["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))] = None
+    return list(words)
+
+
+def generate(args, rng: random.Random) -> None:
+    words = vocabulary(args.vocabulary, rng)
+    weights = list(itertools.accumulate(1 / rank ** 1.1 for rank in range(1, len(words) + 1)))
+
+    users = [{"_id": ObjectId(), "username": f"bench{i}", "email": f"bench{i}@example.com", "password": ""} for i in range(args.users)]
+    db.db.users.insert_many(users)
+    chats = []
+    for _ in range(args.chats):
+        user1, user2 = rng.sample(users, 2)
+        chats.append({"_id": ObjectId(), "user1": str(user1["_id"]), "user2": str(user2["_id"]), "last_message": None})
+    db.db.chats.insert_many(chats)
+
+    start = datetime.now() - timedelta(days=365)
+    started = time.perf_counter()
+    for offset in range(0, args.messages, 10000):
+        messages, entries = [], []
+        for _ in range(min(10000, args.messages - offset)):
+            chat = rng.choice(chats)
+            members = [chat["user1"], chat["user2"]]
+            text = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 25)))
+            sent = start + timedelta(seconds=rng.uniform(0, 365 * 24 * 3600))
+            sent = sent.replace(microsecond=sent.microsecond // 1000 * 1000)
+            message = {"_id": ObjectId(), "chat": str(chat["_id"]), "text": text, "sender": rng.choice(members), "time": sent, "status": "sent", "reply_to": None}
+            messages.append(message)
+            entries.append({"_id": message["_id"], "chat": message["chat"], "time": sent, "users": members, "keys": message_keys(text, members)})
+        db.db.messages.insert_many(messages, ordered=False)
+        db.db.message_search.insert_many(entries, ordered=False)
+        done = offset + len(messages)
+        print(f"\r{done}/{args.messages} messages, {done / (time.perf_counter() - started):.0f}/s", end="", file=sys.stderr)
+    print(file=sys.stderr)
+
+
+def queries(kind: str, count: int, words: List[str], chats: List[dict], rng: random.Random):
+    for _ in range(count):
+        chat = rng.choice(chats)
+        user_id = rng.choice([chat["user1"], chat["user2"]])
+        chat_id = None
+        if kind == "common":
+            q = rng.choice(words[:50]) + " "
+        elif kind == "rare":
+            q = rng.choice(words[min(1000, len(words) // 2):]) + " "
+        elif kind == "two_words":
+            q = f"{rng.choice(words[:200])} {rng.choice(words[:2000])} "
+        elif kind == "prefix":
+            q = rng.choice(words[:500])[:3]
+        else:
+            q = rng.choice(words[:500]) + " "
+            chat_id = str(chat["_id"])
+        yield user_id, q, chat_id
+
+
+async def run_queries(args, rng: random.Random) -> Dict[str, Dict]:
+    # the generator's vocabulary in rank order, recovered from the corpus itself
+    counts: Dict[str, int] = {}
+    for message in db.db.messages.find({}, {"text": 1}).limit(20000):
+        for word in message["text"].split():
+            counts[word] = counts.get(word, 0) + 1
+    words = sorted(counts, key=counts.get, reverse=True)  # type: ignore
+    chats = list(db.db.chats.find({}, {"user1": 1, "user2": 1}))
+
+    results = {}
+    for kind in ("common", "rare", "two_words", "prefix", "in_chat"):
+        samples, hits = [], 0
+        for user_id, q, chat_id in queries(kind, args.queries, words, chats, rng):
+            started = time.perf_counter()
+            page, _ = await db.message_search.search(user_id, q, chat_id=chat_id, limit=20)
+            samples.append((time.perf_counter() - started) * 1000)
+            hits += len(page)
+        results[kind] = {**percentiles(samples), "avg_hits": hits / len(samples)}
+        print(f"{kind:>10}  p50 {results[kind]['p50_ms']:7.2f}ms  p95 {results[kind]['p95_ms']:7.2f}ms  "
+              f"p99 {results[kind]['p99_ms']:7.2f}ms  hits {results[kind]['avg_hits']:.1f}")
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--chats", type=int, default=100_000)
+    parser.add_argument("--vocabulary", type=int, default=30_000)
+    parser.add_argument("--queries", type=int, default=200, help="queries per kind")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reuse", action="store_true", help="benchmark the corpus already in the database")
+    parser.add_argument("--keep", action="store_true", help="leave the corpus in the database")
+    parser.add_argument("--force", action="store_true", help="allow running against the default database")
+    parser.add_argument("--out", help="write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    if MONGO_DB == "chat" and not args.force:
+        raise SystemExit("set MONGO_DB to a scratch database, this benchmark writes and drops collections")
+
+    rng = random.Random(args.seed)
+    ensure_indexes()
+    if not args.reuse:
+        if any(db.db[name].estimated_document_count() for name in COLLECTIONS):
+            raise SystemExit(f"{MONGO_DB} is not empty, use --reuse or an empty database")
+        generate(args, rng)
+
+    try:
+        results = asyncio.run(run_queries(args, rng))
+    finally:
+        if not args.keep and not args.reuse:
+            for name in COLLECTIONS:
+                db.db.drop_collection(name)
+
+    if args.out:
+        save(args.out, "search_messages", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
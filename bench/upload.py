@@ -0,0 +1,120 @@
+"""
+Times image_server uploads against a local stand-in of the imgbb api: files
+of --size bytes are each uploaded once, then again to hit the content hash
+cache. Needs the redis of REDIS_HOST, which gets one cached url per file.
+
+    python -m bench.upload --uploads 200 --size 2000000 --out upload.json
+
+--upstream posts to a real imgbb compatible url instead of the stand-in,
+--upstream-delay makes the stand-in slower to answer
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import requests
+from bson.objectid import ObjectId
+
+from bench.report import compare, percentiles, save
+
+
+class Upstream(BaseHTTPRequestHandler):
+    """
+    Reads the whole body and answers like imgbb, with a url made up for it
+    """
+    delay = 0.0
+    received = 0
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+        Upstream.received += length
+        time.sleep(self.delay)
+        body = json.dumps({"data": {"url": f"http://stand-in/{uuid.uuid4().hex}.png"}, "success": True, "status": 200}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(server) -> str:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=100, help="distinct files, each uploaded twice")
+    parser.add_argument("--size", type=int, default=1_000_000, help="bytes per file")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--upstream", help="imgbb compatible upload url instead of the stand-in")
+    parser.add_argument("--upstream-delay", type=float, default=0.0, help="seconds the stand-in takes to answer")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the results as json to this file")
+    parser.add_argument("--compare", help="json written by an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    stand_in = not args.upstream
+    if stand_in:
+        Upstream.delay = args.upstream_delay
+        args.upstream = serve(ThreadingHTTPServer(("127.0.0.1", 0), Upstream)) + "/1/upload"
+    # read by image_server when it is imported
+    os.environ["IMAGE_UPLOAD_URL"] = args.upstream
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import image_server
+    from utils import crypt
+
+    class Quiet(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    url = serve(make_server("127.0.0.1", 0, image_server.app, threaded=True, request_handler=Quiet)) + "/upload"
+    rng = random.Random(args.seed)
+    files = [rng.randbytes(args.size) for _ in range(args.uploads)]
+    client = requests.Session()
+
+    def upload(content: bytes) -> float:
+        # a token per upload, each one is rate limited for 10 seconds
+        token = crypt.create_tokens(SimpleNamespace(_id=ObjectId()))["refresh"]
+        started = time.perf_counter()
+        response = client.post(url, files={"file": ("image.png", content, "image/png")}, data={"token": token})
+        elapsed = (time.perf_counter() - started) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"upload failed: {response.status_code} {response.text}")
+        return elapsed
+
+    results = {}
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for phase in ("new", "repeat"):
+            started = time.perf_counter()
+            samples = list(pool.map(upload, files))
+            results[phase] = percentiles(samples)
+            results[phase]["per_second"] = len(samples) / (time.perf_counter() - started)
+            print(f"{phase:>8}  " + "  ".join(f"{key} {value:.2f}" for key, value in results[phase].items()))
+    if stand_in:
+        print(f"stand-in received {Upstream.received} bytes")
+
+    if args.out:
+        save(args.out, "upload", vars(args), results)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,4 +6,84 @@ load_dotenv()
 
 BIND_HOST = os.getenv("BIND_HOST", "127.0.0.1")
 BIND_PORT = int(os.getenv("BIND_PORT", "9090"))
+# seconds a single outbound frame may take before that recipient counts as failed
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "5"))
+# frames buffered per connection; when full "drop_oldest" drops queued presence events, "disconnect" closes
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+OUTBOUND_POLICY = os.getenv("OUTBOUND_POLICY", "drop_oldest")
+# requests of one connection handled concurrently
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "8"))
+# per connection token bucket of each action: ACTION_RATE requests a second, bursts of ACTION_BURST,
+# actions with their own limits keep them (0 disables rate limiting)
+ACTION_RATE = float(os.getenv("ACTION_RATE", "20"))
+ACTION_BURST = float(os.getenv("ACTION_BURST", "40"))
 SECRET_KEY = os.getenv("SECRET_KEY")
+# bcrypt cost factor, processes hashing passwords and how many hashes may wait for them
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+CRYPT_WORKERS = int(os.getenv("CRYPT_WORKERS", "2"))
+CRYPT_MAX_PENDING = int(os.getenv("CRYPT_MAX_PENDING", "64"))
+# verified jwt payloads kept to skip re-verifying the same token
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB = os.getenv("MONGO_DB", "chat")
+# threads running blocking pymongo calls, and how many of them one collection may hold
+DB_WORKERS = int(os.getenv("DB_WORKERS", "32"))
+DB_COLLECTION_CONCURRENCY = int(os.getenv("DB_COLLECTION_CONCURRENCY", "16"))
+UPDATES_TTL_DAYS = int(os.getenv("UPDATES_TTL_DAYS", "30"))
+# get_updates page size and cap, and seconds a gap in a user's update log is waited for
+UPDATES_PAGE_SIZE = int(os.getenv("UPDATES_PAGE_SIZE", "100"))
+UPDATES_PAGE_MAX = int(os.getenv("UPDATES_PAGE_MAX", "500"))
+UPDATES_GAP_GRACE = float(os.getenv("UPDATES_GAP_GRACE", "5"))
+# read_message "up_to" calls for the same chat within this many seconds are merged
+READ_DEBOUNCE = float(os.getenv("READ_DEBOUNCE", "0.5"))
+# new messages arriving within this many seconds are written in one batch, of at most MAX_BATCH
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.003"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "200"))
+# search page size and cap, and how many matches are ranked per query
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_PAGE_MAX = int(os.getenv("SEARCH_PAGE_MAX", "50"))
+SEARCH_SCAN = int(os.getenv("SEARCH_SCAN", "500"))
+# keep every user's names in a sorted in-memory index instead of asking mongo (~150 bytes a user).
+# Only this worker's sign ups and renames reach it until restart, so leave off with several workers
+USER_SEARCH_INDEX = os.getenv("USER_SEARCH_INDEX", "0") == "1"
+# index new and edited message text for search_messages
+MESSAGE_SEARCH = os.getenv("MESSAGE_SEARCH", "1") == "1"
+# user and chat lookups cached per process, entries live CACHE_TTL seconds
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "20000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# "local" delivers updates in process, "redis" is needed to run more than one worker
+UPDATE_BUS = os.getenv("UPDATE_BUS", "local")
+WORKERS = int(os.getenv("WORKERS", "1"))
+# with the redis bus, seconds after which a worker that stopped refreshing its presence
+# heartbeat no longer counts its users as online
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "30"))
+# prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics, worker n on METRICS_PORT + n (0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))
+# profile every request of PROFILE_ACTIONS (comma separated) and 1 in PROFILE_SAMPLE others (0: none),
+# those slower than SLOW_ACTION_SECONDS go to the rotating SLOW_LOG. Changeable at runtime on METRICS_PORT /profile
+PROFILE_SAMPLE = int(os.getenv("PROFILE_SAMPLE", "0"))
+PROFILE_ACTIONS = {action for action in os.getenv("PROFILE_ACTIONS", "").split(",") if action}
+SLOW_ACTION_SECONDS = float(os.getenv("SLOW_ACTION_SECONDS", "1"))
+SLOW_LOG = os.getenv("SLOW_LOG", "slow.log")
+SLOW_LOG_MAX_BYTES = int(os.getenv("SLOW_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SLOW_LOG_BACKUPS = int(os.getenv("SLOW_LOG_BACKUPS", "5"))
+# DEBUG also logs every frame received and sent, LOG_FORMAT "text" or "json", LOG_FILE empty for stdout
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FILE = os.getenv("LOG_FILE", "")
+# logged strings longer than LOG_MAX_FIELD and frames longer than LOG_MAX_PAYLOAD are cut
+LOG_MAX_FIELD = int(os.getenv("LOG_MAX_FIELD", "200"))
+LOG_MAX_PAYLOAD = int(os.getenv("LOG_MAX_PAYLOAD", "2000"))
+# log 1 in N frames of busy actions at DEBUG, e.g. "new_message=100,typing=1000"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+
+# chats whose newest messages are kept in memory (0 disables), and how many per chat.
+# Off by default with the redis bus, other workers' writes would not reach it
+MESSAGE_CACHE_CHATS = int(os.getenv("MESSAGE_CACHE_CHATS", "1000" if UPDATE_BUS == "local" else "0"))
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "50"))
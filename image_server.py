@@ -1,25 +1,109 @@
+import hashlib
+import io
 import os
+import uuid
+from typing import IO, Dict, Iterator, List, Tuple
 
 import requests
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 import redis
-from utils.crypt import refresh_access_token, validate_access_token
+from requests.adapters import HTTPAdapter
+from werkzeug.utils import secure_filename
+from utils.crypt import validate_refresh_token
 
 load_dotenv()
 
 IMGBB_API_KEY = os.getenv('IMGBB_API_KEY')
+# where images are posted, an imgbb compatible api, e.g. the stand-in of bench/upload.py
+IMAGE_UPLOAD_URL = os.getenv("IMAGE_UPLOAD_URL", "https://api.imgbb.com/1/upload")
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(16 * 1024 * 1024)))
+IMAGE_UPLOAD_TIMEOUT = float(os.getenv("IMAGE_UPLOAD_TIMEOUT", "60"))
+# keep-alive connections to the upstream host kept open
+IMAGE_UPLOAD_POOL = int(os.getenv("IMAGE_UPLOAD_POOL", "10"))
+# how long the url of an uploaded file is reused for the same content
+IMAGE_URL_TTL = int(os.getenv("IMAGE_URL_TTL", str(30 * 24 * 3600)))
+
+CHUNK = 64 * 1024
 
 app = Flask(__name__)
+# werkzeug refuses a larger body with 413 before parsing it, the rest is form overhead
+app.config["MAX_CONTENT_LENGTH"] = IMAGE_MAX_BYTES + 64 * 1024
 cache = redis.Redis(
     host=os.getenv("REDIS_HOST", ""),
     port=int(os.getenv("REDIS_PORT", "6379")),
     db=0
 )
 
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=IMAGE_UPLOAD_POOL)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body of some text fields and one file, read by
+    requests in chunks instead of being built in memory
+    """
+
+    def __init__(self, fields: Dict[str, str], name: str, filename: str, file: IO[bytes], size: int, content_type: str) -> None:
+        self.boundary = uuid.uuid4().hex
+        head = b"".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode()
+            for key, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._parts: List[IO[bytes]] = [io.BytesIO(head), file, io.BytesIO(tail)]
+        self._length = len(head) + size + len(tail)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        # gives requests the Content-Length, so the body isn't sent chunked
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        size = CHUNK if size is None or size < 0 else size
+        while self._parts:
+            chunk = self._parts[0].read(size)
+            if chunk:
+                return chunk
+            self._parts.pop(0)
+        return b""
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(lambda: self.read(CHUNK), b"")
+
+
+def digest(file: IO[bytes]) -> Tuple[str, int]:
+    """
+    sha256 and size of a file, read in chunks and rewound
+    """
+    sha, size = hashlib.sha256(), 0
+    for chunk in iter(lambda: file.read(CHUNK), b""):
+        sha.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return sha.hexdigest(), size
+
+
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify({'error': f'File is larger than {IMAGE_MAX_BYTES} bytes'}), 413
+
 
 @app.route('/upload', methods=['POST'])
 def upload():
+    if request.content_length and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        return too_large(None)
+
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
 
@@ -31,30 +115,36 @@ def upload():
     if cache.get(token):
         return jsonify({"error": "you caught to rate limiting, please try again in 10 seconds"}), 403
 
-    is_valid = refresh_access_token(token)
-    if not is_valid:
+    if not validate_refresh_token(token):
         return jsonify({"error": "please give valid refresh_token"}), 403
 
+    # werkzeug spooled the file to disk past 500KB, hashing reads it back in chunks
+    sha, size = digest(file.stream)
+    if size > IMAGE_MAX_BYTES:
+        return too_large(None)
 
-    # convert file to base64
-    import base64
-    encoded_file = base64.b64encode(file.read()).decode('utf-8')
+    # the same content was uploaded before, nothing to send
+    url = cache.get(f"image:{sha}")
+    if url:
+        return jsonify({'url': url.decode()})
 
-    # upload to imgbb
-    response = requests.post(
-        'https://api.imgbb.com/1/upload',
-        data={
-            'key': IMGBB_API_KEY,
-            'image': encoded_file
-        }
+    body = MultipartStream(
+        {'key': IMGBB_API_KEY or ""}, 'image', secure_filename(file.filename or "") or "image",
+        file.stream, size, file.mimetype or "application/octet-stream",
     )
+    try:
+        response = session.post(IMAGE_UPLOAD_URL, data=body, headers={"Content-Type": body.content_type}, timeout=IMAGE_UPLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        return jsonify({'error': 'Upload failed', 'details': str(e)}), 502
 
     if response.status_code == 200:
         data = response.json()
+        url = data['data']['url']
         cache.setex(token, 10, "used")
-        return jsonify({'url': data['data']['url']})
+        cache.setex(f"image:{sha}", IMAGE_URL_TTL, url)
+        return jsonify({'url': url})
     else:
-        return jsonify({'error': 'Upload failed', 'details': response.text}), 500
+        return jsonify({'error': 'Upload failed', 'details': response.text[:1000]}), 500
 
 if __name__ == '__main__':
     app.run(debug=True)
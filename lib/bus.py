@@ -0,0 +1,174 @@
+import asyncio
+import json
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import redis.asyncio as redis
+
+from conf import PRESENCE_TTL, REDIS_HOST, REDIS_PORT, UPDATE_BUS
+from lib.db import Update
+from lib.log import get_logger
+
+log = get_logger("bus")
+
+Deliver = Callable[[Update], Awaitable[None]]
+# (user ids, encoded frame, coalesce key): a frame not stored anywhere, e.g. a status change
+DeliverFrame = Callable[[List[str], str, Optional[str]], Awaitable[None]]
+
+
+class LocalBus:
+    """
+    Hands updates straight to this process' server, for a single worker and tests
+    """
+
+    def __init__(self, deliver: Deliver, deliver_frame: DeliverFrame) -> None:
+        self.deliver = deliver
+        self.deliver_frame = deliver_frame
+
+    async def start(self) -> None:
+        pass
+
+    async def publish(self, update: Update) -> None:
+        await self.deliver(update)
+
+    async def publish_frame(self, user_ids: Iterable[str], data: str, key: Optional[str] = None) -> None:
+        await self.deliver_frame([str(user_id) for user_id in user_ids], data, key)
+
+    async def online(self, user_ids: Iterable[str]) -> Set[str]:
+        # no other workers, the registry already answered
+        return set()
+
+    def subscribe(self, user_id: str) -> None:
+        pass
+
+    def unsubscribe(self, user_id: str) -> None:
+        pass
+
+
+class RedisBus:
+    """
+    Publishes every update on one redis channel per recipient; each worker
+    listens only on the channels of users connected to it.
+
+    Presence lives in redis too: PRESENCE holds the ids of the workers a user
+    is connected to, kept by subscribe/unsubscribe, and each worker refreshes
+    a WORKER key every PRESENCE_TTL / 3 seconds so the entries of a worker
+    that died stop counting
+    """
+
+    CHANNEL = "updates:{}"
+    PRESENCE = "presence:{}"
+    WORKER = "presence:worker:{}"
+
+    def __init__(self, deliver: Deliver, deliver_frame: DeliverFrame, host: str = REDIS_HOST, port: int = REDIS_PORT) -> None:
+        self.deliver = deliver
+        self.deliver_frame = deliver_frame
+        self.redis = redis.Redis(host=host, port=port)
+        self.pubsub = self.redis.pubsub()
+        self.worker_id = uuid.uuid4().hex
+        self._reader: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        # the last subscribe/unsubscribe of each user, awaited before presence is read
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    async def start(self) -> None:
+        await self.redis.set(self.WORKER.format(self.worker_id), 1, ex=PRESENCE_TTL)
+        self._heartbeat = asyncio.create_task(self._beat())
+        self._reader = asyncio.create_task(self._listen())
+
+    async def publish(self, update: Update) -> None:
+        payload = {"type": update.type, "body": update.body, "id": str(update._id)}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in set(update.users):
+                pipe.publish(self.CHANNEL.format(user_id), json.dumps({**payload, "seq": update.seqs.get(user_id)}))
+            await pipe.execute()
+
+    async def publish_frame(self, user_ids: Iterable[str], data: str, key: Optional[str] = None) -> None:
+        message = json.dumps({"frame": data, "key": key})
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in set(map(str, user_ids)):
+                pipe.publish(self.CHANNEL.format(user_id), message)
+            await pipe.execute()
+
+    async def online(self, user_ids: Iterable[str]) -> Set[str]:
+        user_ids = [str(user_id) for user_id in user_ids]
+        pending = [self._pending[user_id] for user_id in user_ids if user_id in self._pending]
+        if pending:
+            await asyncio.wait(pending)
+        if not user_ids:
+            return set()
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.smembers(self.PRESENCE.format(user_id))
+            members = [{worker.decode() for worker in workers} for workers in await pipe.execute()]
+        workers = sorted(set().union(*members))
+        if not workers:
+            return set()
+        beats = await self.redis.mget([self.WORKER.format(worker) for worker in workers])
+        alive = {worker for worker, beat in zip(workers, beats) if beat}
+        return {user_id for user_id, workers in zip(user_ids, members) if workers & alive}
+
+    def subscribe(self, user_id: str) -> None:
+        self._track(user_id, self._join(user_id))
+
+    def unsubscribe(self, user_id: str) -> None:
+        self._track(user_id, self._leave(user_id))
+
+    def _track(self, user_id: str, coro) -> None:
+        previous = self._pending.get(user_id)
+
+        async def run():
+            # in call order, a quick reconnect must not leave the user absent
+            if previous is not None:
+                await asyncio.wait([previous])
+            try:
+                await coro
+            except Exception:
+                log.exception("presence update failed", extra={"fields": {"user": user_id}})
+
+        task = asyncio.create_task(run())
+        self._pending[user_id] = task
+        task.add_done_callback(lambda t: self._pending.pop(user_id, None) if self._pending.get(user_id) is t else None)
+
+    async def _join(self, user_id: str) -> None:
+        await self.pubsub.subscribe(self.CHANNEL.format(user_id))
+        await self.redis.sadd(self.PRESENCE.format(user_id), self.worker_id)
+
+    async def _leave(self, user_id: str) -> None:
+        await self.redis.srem(self.PRESENCE.format(user_id), self.worker_id)
+        await self.pubsub.unsubscribe(self.CHANNEL.format(user_id))
+
+    async def _beat(self) -> None:
+        while True:
+            await asyncio.sleep(PRESENCE_TTL / 3)
+            try:
+                await self.redis.set(self.WORKER.format(self.worker_id), 1, ex=PRESENCE_TTL)
+            except Exception:
+                log.exception("presence heartbeat failed")
+
+    async def _listen(self) -> None:
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if not message:
+                    continue
+                user_id = message["channel"].decode().split(":", 1)[1]
+                data = json.loads(message["data"])
+                if "frame" in data:
+                    await self.deliver_frame([user_id], data["frame"], data["key"])
+                    continue
+                update = Update(type=data["type"], body=data["body"], users=[user_id], _id=data["id"], seqs={user_id: data["seq"]})
+                await self.deliver(update)
+            except Exception:
+                log.exception("update delivery failed")
+                await asyncio.sleep(1)
+
+
+def create_bus(deliver: Deliver, deliver_frame: DeliverFrame, kind: str = UPDATE_BUS):
+    if kind == "redis":
+        return RedisBus(deliver, deliver_frame)
+    return LocalBus(deliver, deliver_frame)
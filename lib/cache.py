@@ -0,0 +1,266 @@
+import time
+from bisect import insort
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+
+# rough per-message overhead of the dataclass and its fields, on top of the text
+MESSAGE_OVERHEAD = 200
+# uncached chats whose write count is remembered, past that the oldest are forgotten
+WRITTEN_CHATS = 4096
+
+
+class TTLCache:
+    """
+    Size bounded LRU whose entries also expire `ttl` seconds after being set
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        item = self._items.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+def _key(message) -> tuple:
+    return (message.time, ObjectId(message._id))
+
+
+class _ChatBuffer:
+    def __init__(self) -> None:
+        # newest messages of the chat, contiguous and ordered by (time, _id)
+        self.keys: List[tuple] = []
+        self.messages: Dict[tuple, object] = {}
+        self.ids: Dict[str, tuple] = {}
+        # True while the buffer holds every message of the chat, otherwise
+        # older messages are known to exist
+        self.complete = False
+        # writes to the chat, carried over from MessageCache._written
+        self.version = 0
+
+
+class MessageCache:
+    """
+    LRU of per-chat buffers holding the newest messages of recently active chats
+    """
+
+    def __init__(self, max_chats: int, size: int) -> None:
+        self.max_chats = max_chats
+        self.size = size
+        self._chats: "OrderedDict[str, _ChatBuffer]" = OrderedDict()
+        self._chat_of: Dict[str, str] = {}
+        # writes to chats that aren't cached, so a fill started before one is dropped
+        self._written: "OrderedDict[str, int]" = OrderedDict()
+        # bumped by writes to messages whose chat is unknown
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.approx_bytes = 0
+
+    def _buffer(self, chat_id: str, create: bool = False) -> Optional[_ChatBuffer]:
+        buffer = self._chats.get(chat_id)
+        if buffer is None and create and self.max_chats > 0:
+            buffer = self._chats[chat_id] = _ChatBuffer()
+            buffer.version = self._written.pop(chat_id, 0)
+            while len(self._chats) > self.max_chats:
+                self._forget(next(iter(self._chats)))
+                self.evictions += 1
+        if buffer is not None:
+            self._chats.move_to_end(chat_id)
+        return buffer
+
+    def _forget(self, chat_id: str) -> None:
+        buffer = self._chats.pop(chat_id, None)
+        if buffer is not None:
+            self._drop(buffer)
+            # a fill that read the chat while it was cached must not seed it again
+            self._remember(chat_id, buffer.version + 1)
+
+    def _bump(self, chat_id: str) -> None:
+        buffer = self._chats.get(chat_id)
+        if buffer is not None:
+            buffer.version += 1
+        else:
+            self._remember(chat_id, self._written.get(chat_id, 0) + 1)
+
+    def _remember(self, chat_id: str, writes: int) -> None:
+        self._written[chat_id] = writes
+        self._written.move_to_end(chat_id)
+        while len(self._written) > WRITTEN_CHATS:
+            self._written.popitem(last=False)
+            # the forgotten chat's count restarts at 0, which a fill could mistake for no writes
+            self._generation += 1
+
+    def _drop(self, buffer: _ChatBuffer) -> None:
+        for message in buffer.messages.values():
+            self._chat_of.pop(str(message._id), None)
+            self.approx_bytes -= MESSAGE_OVERHEAD + len(message.text or "")
+
+    def _insert(self, chat_id: str, buffer: _ChatBuffer, message) -> None:
+        key = _key(message)
+        if buffer.keys and key < buffer.keys[0] and not buffer.complete:
+            # older than the cached window, the buffer would stop being contiguous
+            return
+        insort(buffer.keys, key)
+        buffer.messages[key] = message
+        buffer.ids[str(message._id)] = key
+        self._chat_of[str(message._id)] = chat_id
+        self.approx_bytes += MESSAGE_OVERHEAD + len(message.text or "")
+        while len(buffer.keys) > self.size:
+            oldest = buffer.messages.pop(buffer.keys.pop(0))
+            buffer.ids.pop(str(oldest._id), None)
+            self._chat_of.pop(str(oldest._id), None)
+            self.approx_bytes -= MESSAGE_OVERHEAD + len(oldest.text or "")
+            buffer.complete = False
+
+    def _remove(self, buffer: _ChatBuffer, message_id: str) -> None:
+        key = buffer.ids.pop(message_id, None)
+        if key is None:
+            return
+        buffer.keys.remove(key)
+        message = buffer.messages.pop(key)
+        self._chat_of.pop(message_id, None)
+        self.approx_bytes -= MESSAGE_OVERHEAD + len(message.text or "")
+
+    def version(self, chat_id: str) -> Tuple[int, int]:
+        buffer = self._chats.get(chat_id)
+        return (buffer.version if buffer else self._written.get(chat_id, 0), self._generation)
+
+    def get(self, message_id: str):
+        chat_id = self._chat_of.get(str(message_id))
+        if chat_id is None:
+            return None
+        buffer = self._chats[chat_id]
+        return buffer.messages[buffer.ids[str(message_id)]]
+
+    def newest(self, chat_id: str, limit: int) -> Optional[Tuple[List, bool]]:
+        """
+        Newest `limit` messages of a chat oldest first and whether older ones
+        exist, or None when the buffer can't answer
+        """
+        buffer = self._buffer(chat_id)
+        if buffer is not None and (len(buffer.keys) >= limit or buffer.complete):
+            self.hits += 1
+            keys = buffer.keys[-limit:]
+            return [buffer.messages[key] for key in keys], len(buffer.keys) > limit or not buffer.complete
+        self.misses += 1
+        return None
+
+    def fill(self, chat_id: str, messages: List, has_more: bool, version: Tuple[int, int]) -> None:
+        """
+        Seed a chat from a newest page read from the db, unless the chat was
+        written to since `version` was taken
+        """
+        if self.version(chat_id) != version:
+            return
+        buffer = self._buffer(chat_id, create=True)
+        if buffer is None:
+            return
+        self._drop(buffer)
+        buffer.keys = []
+        buffer.messages = {}
+        buffer.ids = {}
+        buffer.complete = True
+        for message in messages:
+            self._insert(chat_id, buffer, message)
+        buffer.complete = not has_more and len(messages) <= self.size
+
+    def add(self, message) -> None:
+        chat_id = str(message.chat)
+        # only fill seeds a buffer: one message says nothing about what else
+        # the chat holds, e.g. when it carries an older client timestamp
+        buffer = self._buffer(chat_id)
+        self._bump(chat_id)
+        if buffer is None:
+            return
+        self._remove(buffer, str(message._id))
+        self._insert(chat_id, buffer, message)
+
+    def update(self, message_id: str, data: dict, chat_id: Optional[str] = None) -> None:
+        """
+        Apply `data` to a cached message, `chat_id` spares fills of other
+        chats when the message isn't cached
+        """
+        message = self.get(message_id)
+        if message is None:
+            if chat_id:
+                self._bump(chat_id)
+            else:
+                self._generation += 1
+            return
+        self._bump(str(message.chat))
+        for name, value in data.items():
+            if name == "text":
+                self.approx_bytes += len(value or "") - len(message.text or "")
+            setattr(message, name, value)
+
+    def update_chat(self, chat_id: str, data: dict, where: Callable[[Any], bool]) -> None:
+        """
+        Apply `data` to the cached messages of a chat matching `where`,
+        mirroring a range update_many in the db
+        """
+        self._bump(chat_id)
+        buffer = self._chats.get(chat_id)
+        if buffer is None:
+            return
+        for message in buffer.messages.values():
+            if where(message):
+                for name, value in data.items():
+                    setattr(message, name, value)
+
+    def remove(self, message_id: str, chat_id: Optional[str] = None) -> None:
+        cached_in = self._chat_of.get(str(message_id))
+        if cached_in is None:
+            if chat_id:
+                self._bump(chat_id)
+            else:
+                self._generation += 1
+            return
+        self._bump(cached_in)
+        self._remove(self._chats[cached_in], str(message_id))
+
+    def discard(self, chat_id: str) -> None:
+        """
+        Forget a chat whose newest messages in the db aren't known, the next read refills it
+        """
+        self._forget(chat_id)
+        self._bump(chat_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self._chats),
+            "messages": len(self._chat_of),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "approx_bytes": self.approx_bytes,
+        }
@@ -1,16 +1,45 @@
-from typing import Optional
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
 
 from websockets import ServerConnection
 from websockets.protocol import State
 
+from conf import OUTBOUND_POLICY, OUTBOUND_QUEUE_SIZE, SEND_TIMEOUT
 from lib.db import User
+from lib.dispatch import TokenBucket
+from lib.metrics import metrics
+from lib.registry import ConnectionRegistry
+from utils.exceptions import SlowConsumerException
+
+OUTBOUND_BYTES = metrics.counter("chat_outbound_bytes_total", "Bytes of frames written to sockets")
+OUTBOUND_FRAMES = metrics.counter("chat_outbound_frames_total", "Outbound frames by what happened to them", ("result",))
 
 
 class Connection:
-    def __init__(self, websocket: ServerConnection, addr) -> None:
+    def __init__(
+        self,
+        websocket: ServerConnection,
+        addr,
+        registry: Optional[ConnectionRegistry] = None,
+        queue_size: int = OUTBOUND_QUEUE_SIZE,
+        policy: str = OUTBOUND_POLICY,
+    ) -> None:
         self.websocket: ServerConnection = websocket
         self.addr = addr
         self.user: Optional[User] = None
+        self.registry = registry
+        # rate limit of each action this connection called
+        self.buckets: Dict[str, TokenBucket] = {}
+
+        # outbound frames as (coalesce key, ephemeral, data), drained by the writer task
+        self.queue: Deque[Tuple[Optional[str], bool, str]] = deque()
+        self.queue_size = queue_size
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
 
     @property
     def is_authenticated(self) -> bool:
@@ -18,9 +47,76 @@ class Connection:
 
     def authenticate(self, user: User):
         self.user = user
+        if self.registry is not None:
+            self.registry.add(self)
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+
+    def stop(self):
+        if self._writer:
+            self._writer.cancel()
+            self._writer = None
+
+    async def send(self, data, key: Optional[str] = None, ephemeral: bool = False):
+        """
+        Queue a frame for the writer task. A frame with a `key` replaces a
+        queued frame with the same key, `ephemeral` frames may be dropped
+        when the queue is full
+        """
+        if self._writer is None:
+            await self.websocket.send(data)
+            OUTBOUND_BYTES.inc(len(data))
+            OUTBOUND_FRAMES.inc(1, "sent")
+            return
+
+        if key is not None:
+            for i, (queued_key, _, _) in enumerate(self.queue):
+                if queued_key == key:
+                    self.queue[i] = (key, ephemeral, data)
+                    self.coalesced += 1
+                    OUTBOUND_FRAMES.inc(1, "coalesced")
+                    return
 
-    async def send(self, data):
-        await self.websocket.send(data)
+        if len(self.queue) >= self.queue_size and not self._make_room():
+            OUTBOUND_FRAMES.inc(1, "overflow")
+            asyncio.create_task(self.close())
+            raise SlowConsumerException()
+
+        self.queue.append((key, ephemeral, data))
+        self._ready.set()
+
+    def _make_room(self) -> bool:
+        if self.policy != "drop_oldest":
+            return False
+        for i, (_, ephemeral, _) in enumerate(self.queue):
+            if ephemeral:
+                del self.queue[i]
+                self.dropped += 1
+                OUTBOUND_FRAMES.inc(1, "dropped")
+                return True
+        return False
+
+    async def _write(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                _, _, data = self.queue.popleft()
+                await asyncio.wait_for(self.websocket.send(data), SEND_TIMEOUT)
+                OUTBOUND_BYTES.inc(len(data))
+                OUTBOUND_FRAMES.inc(1, "sent")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # stalled past SEND_TIMEOUT or already closed
+            self._writer = None
+            await self.close()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
 
     async def recv(self):
         return await self.websocket.recv()
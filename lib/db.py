@@ -1,16 +1,90 @@
-from dataclasses import asdict, dataclass, field
-from datetime import datetime
+import asyncio
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timedelta
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
 
 from bson.objectid import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
 from pymongo.results import UpdateResult
 
+from conf import (CACHE_TTL, CHAT_CACHE_SIZE, DB_COLLECTION_CONCURRENCY, DB_WORKERS, GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_WINDOW,
+                  MESSAGE_CACHE_CHATS, MESSAGE_CACHE_SIZE, MESSAGE_SEARCH, MONGO_DB, MONGO_URI, SEARCH_SCAN, UPDATES_GAP_GRACE,
+                  USER_CACHE_SIZE, USER_SEARCH_INDEX)
+from lib.cache import MessageCache, TTLCache
+from lib.log import get_logger
+from lib.metrics import metrics
+from lib.profiling import current_trace, query_listener, traced
+from lib.search import PrefixIndex, match, message_keys, name_keys, normalize, parse_query, rank
+from utils.exceptions import CommitException
 from utils.server_holder import handle_update
 
-client = MongoClient()
-db = client.chat
+client = MongoClient(MONGO_URI, event_listeners=[query_listener])
+db = client[MONGO_DB]
+
+T = TypeVar("T")
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+_limits: Dict[str, asyncio.Semaphore] = {}
+
+log = get_logger("db")
+
+DB_SECONDS = metrics.histogram("chat_db_seconds", "Database calls by manager method, queueing included", ("method", "collection"))
+DB_WAIT_SECONDS = metrics.histogram("chat_db_wait_seconds", "Time database calls waited for a slot and an executor thread", ("collection",))
+SEARCH_INDEX_FAILURES = metrics.counter("chat_search_index_failures_total", "Messages stored but not indexed for search, python -m lib.indexes --reindex-messages adds them")
+
+message_cache = MessageCache(MESSAGE_CACHE_CHATS, MESSAGE_CACHE_SIZE)
+user_cache = TTLCache(USER_CACHE_SIZE, CACHE_TTL)
+chat_cache = TTLCache(CHAT_CACHE_SIZE, CACHE_TTL)
+# chat ids by their sorted (user1, user2) pair, for check_exists
+chat_pair_cache = TTLCache(CHAT_CACHE_SIZE, CACHE_TTL)
+# usernames and full names of every user, when USER_SEARCH_INDEX is on
+user_search_index = PrefixIndex() if USER_SEARCH_INDEX else None
+
+
+def _pair(user1, user2) -> Tuple[str, str]:
+    return tuple(sorted((str(user1), str(user2))))  # type: ignore
+
+
+async def run(collection: str, func: Callable[[Collection], T]) -> T:
+    """
+    Run a blocking pymongo call against `collection` on the db executor,
+    so a slow query only holds one worker instead of the event loop.
+    Time is recorded against the manager method that called
+    """
+    caller = sys._getframe(1).f_code
+    method = getattr(caller, "co_qualname", caller.co_name)
+    semaphore = _limits.get(collection)
+    if semaphore is None:
+        semaphore = _limits[collection] = asyncio.Semaphore(DB_COLLECTION_CONCURRENCY)
+
+    queued = time.perf_counter()
+    began = queued
+    trace = current_trace()
+
+    def call(c: Collection) -> T:
+        nonlocal began
+        began = time.perf_counter()
+        with traced(trace, method):
+            return func(c)
+
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(_executor, call, db[collection])
+        finally:
+            DB_WAIT_SECONDS.observe(began - queued, collection)
+            DB_SECONDS.observe(time.perf_counter() - queued, method, collection)
+
+
+# fields User.serialize reads, for queries that only hydrate other people's profiles
+USER_PUBLIC_FIELDS = {"username": 1, "email": 1, "avatar": 1, "full_name": 1, "last_seen": 1}
 
 
 @dataclass
@@ -22,6 +96,11 @@ class User:
     avatar: Optional[str] = None
     full_name: Optional[str] = None
     last_seen: Optional[datetime] = field(default_factory=datetime.now)
+    # normalized name keys behind the anchored prefix search
+    search_keys: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.search_keys = name_keys(self.username, self.full_name)
 
     def __repr__(self) -> str:
         return f"<{self._id} - {self.username}>"
@@ -50,13 +129,16 @@ class Chat:
     def __repr__(self) -> str:
         return f"<{self._id} - {self.user1} - {self.user2}>"
 
-    def serialize(self, user: User, serialize_user=True):
-        if str(self.user1) == str(user._id):
-            other_user_id = self.user2
-        else:
-            other_user_id = self.user1
+    def other_user_id(self, user_id) -> str:
+        if str(self.user1) == str(user_id):
+            return self.user2
+        return self.user1
+
+    async def serialize(self, user: User, serialize_user=True, other_user: Optional[User] = None):
+        other_user_id = self.other_user_id(user._id)
         if serialize_user:
-            other_user = UserManager().get(id=other_user_id)
+            if other_user is None:
+                other_user = await UserManager().get(id=other_user_id)
             other_user = other_user.serialize() if other_user else user.serialize()
         else:
             other_user = other_user_id
@@ -85,15 +167,25 @@ class Message:
 
     reply_to: Optional[str] = None
 
-    def serialize(self, user=None):
-        if self.reply_to:
-            reply_to = MessageManager().get(id=self.reply_to)
-            if reply_to:
-                reply_to = reply_to.serialize(user=user)
-            else:
-                reply_to = None
-        else:
-            reply_to = None
+    def __post_init__(self):
+        # match what a read back from mongo returns: the cache hands these objects
+        # out, and the id is known before the (batched) insert
+        if self._id is None:
+            self._id = ObjectId()  # type: ignore
+        self.sender = str(self.sender)
+        if self.time:
+            self.time = self.time.replace(microsecond=self.time.microsecond // 1000 * 1000)
+
+    def serialize(self, user=None, replies: Optional[Dict[str, "Message"]] = None, depth: int = 1):
+        """
+        `replies` maps message id to already loaded reply targets, quoted
+        down to `depth` levels; deeper targets serialize as None
+        """
+        reply_to = None
+        if self.reply_to and depth > 0 and replies:
+            target = replies.get(str(self.reply_to))
+            if target:
+                reply_to = target.serialize(user=user, replies=replies, depth=depth - 1)
         data = {
             "id": str(self._id),
             "text": self.text,
@@ -125,13 +217,16 @@ class Update:
     users: List[str]
     created_at: Optional[datetime] = field(default_factory=datetime.now)
     _id: Optional[str] = None
+    # position of this update in each recipient's update log
+    seqs: Dict[str, int] = field(default_factory=dict)
 
-    def to_dict(self):
+    def to_dict(self, user: Optional[str] = None):
         return {
             "type": self.type,
             "body": self.body,
             "created_at": self.created_at.timestamp() if self.created_at else None,
-            "id": str(self._id)
+            "id": str(self._id),
+            "seq": self.seqs.get(str(user)) if user else None
         }
 
 
@@ -139,9 +234,13 @@ class UserManager:
     def __init__(self) -> None:
         pass
 
-    def get(
+    async def get(
         self, id: Optional[str] = None, username: Optional[str] = None, email: Optional[str] = None
     ) -> Optional[User]:
+        if id and not username and not email:
+            cached = user_cache.get(str(id))
+            if cached:
+                return replace(cached)
         query = {}
         if id:
             object_id = ObjectId(id)
@@ -150,141 +249,630 @@ class UserManager:
             query["username"] = username
         if email:
             query["email"] = email
-        item = db.users.find_one(query)
+        item = await run("users", lambda c: c.find_one(query))
         if item:
-            return User(**item)
+            user = User(**item)
+            user_cache.set(str(user._id), replace(user))
+            return user
         return None
 
-    def check_exists(self, username: Optional[str] = None, email: Optional[str] = None) -> Dict[str, bool]:
-        username_exists = db.users.find_one({"username": username}) is not None if username else False
-        email_exists = db.users.find_one({"email": email}) is not None if email else False
+    async def get_many(self, ids: Iterable[str]) -> Dict[str, User]:
+        """
+        Fetch public profiles of several users in one query, keyed by id.
+        Password is not loaded, so the result must not be written back
+        """
+        found = {}
+        object_ids = []
+        for id in {str(id) for id in ids}:
+            cached = user_cache.get(id)
+            if cached:
+                found[id] = replace(cached)
+            else:
+                object_ids.append(ObjectId(id))
+        if object_ids:
+            items = await run("users", lambda c: list(c.find({"_id": {"$in": object_ids}}, USER_PUBLIC_FIELDS)))
+            found.update({str(item["_id"]): User(password="", **item) for item in items})
+        return found
+
+    async def check_exists(self, username: Optional[str] = None, email: Optional[str] = None) -> Dict[str, bool]:
+        username_exists = await run("users", lambda c: c.find_one({"username": username})) is not None if username else False
+        email_exists = await run("users", lambda c: c.find_one({"email": email})) is not None if email else False
 
         return {"username": username_exists, "email": email_exists}
 
-    def create(self, user: User) -> User:
+    async def create(self, user: User) -> User:
         data = asdict(user)
         data.pop("_id")  # let mongodb assign random id
-        item = db.users.insert_one(data)
+        item = await run("users", lambda c: c.insert_one(data))
         user._id = item.inserted_id
+        if user_search_index is not None:
+            user_search_index.add(str(user._id), user.username, user.full_name)
         return user
 
-    def update(self, user_id, user: User) -> User:
+    async def update(self, user_id, user: User) -> User:
         user_id = ObjectId(user_id) if type(user_id) is str else user_id
         data = asdict(user)
         data.pop("_id")
-        db.users.update_one({"_id": user_id}, {"$set": data})
+        await run("users", lambda c: c.update_one({"_id": user_id}, {"$set": data}))
         user._id = user_id
+        user_cache.set(str(user_id), replace(user))
+        if user_search_index is not None:
+            user_search_index.add(str(user_id), user.username, user.full_name)
         return user
 
-    def search(self, q: str) -> List[User]:
-        users = db.users.find({"username": {"$regex": q, "$options": "i"}}).limit(10)
-        users = [User(**user) for user in users]
-
-        return users
+    async def search(self, q: Optional[str], offset: int = 0, limit: int = 20) -> Tuple[List[User], bool]:
+        """
+        Users whose username, full name or a word of it starts with `q`, ranked
+        exact, username prefix, full name prefix, word prefix. Only the first
+        SEARCH_SCAN matches are ranked, `offset`/`limit` page through them.
+        Returns (users, has_more), password is not loaded
+        """
+        q = normalize(q)
+        if not q:
+            return [], False
+
+        if user_search_index is not None:
+            ids = user_search_index.search(q, SEARCH_SCAN)
+            page = ids[offset:offset + limit]
+            found = await self.get_many(page)
+            users = [found[id] for id in page if id in found]
+            return users, offset + limit < len(ids)
+
+        # anchored and escaped, so the regex is answered from the search_keys index bounds
+        query = {"search_keys": {"$regex": "^" + re.escape(q)}}
+        items = await run("users", lambda c: list(c.find(query, USER_PUBLIC_FIELDS).limit(SEARCH_SCAN)))
+        users = sorted((User(password="", **item) for item in items), key=lambda user: rank(q, normalize(user.username), normalize(user.full_name)))
+        return users[offset:offset + limit], offset + limit < len(users)
+
+    async def load_search_index(self) -> int:
+        """
+        Fill user_search_index from the users collection, returns how many users it holds
+        """
+        if user_search_index is None:
+            return 0
+        fields = {"username": 1, "full_name": 1}
+        items = await run("users", lambda c: list(c.find({}, fields)))
+        user_search_index.load((str(item["_id"]), item["username"], item.get("full_name")) for item in items)
+        return len(user_search_index)
 
 
 class ChatManager:
     def __init__(self) -> None:
         pass
 
-    def get(self, id: str) -> Optional[Chat]:
-        chat = db.chats.find_one({"_id": ObjectId(id)})
-        return Chat(**chat) if chat else None
+    async def get(self, id: str) -> Optional[Chat]:
+        cached = chat_cache.get(str(id))
+        if cached:
+            return replace(cached)
+        chat = await run("chats", lambda c: c.find_one({"_id": ObjectId(id)}))
+        if not chat:
+            return None
+        chat = Chat(**chat)
+        self._remember(chat)
+        return chat
+
+    def _remember(self, chat: Chat) -> None:
+        chat_cache.set(str(chat._id), replace(chat))
+        chat_pair_cache.set(_pair(chat.user1, chat.user2), str(chat._id))
 
-    def get_user_chats(self, user_id: str) -> List[Chat]:
-        chats = db.chats.find({"$or": [{"user1": str(user_id)}, {"user2": str(user_id)}]}).sort("updated_at", -1)
+    async def get_user_chats(self, user_id: str) -> List[Chat]:
+        query = {"$or": [{"user1": str(user_id)}, {"user2": str(user_id)}]}
+        chats = await run("chats", lambda c: list(c.find(query).sort("updated_at", -1)))
         chats = [Chat(**chat) for chat in chats]
         return chats
 
-    def create(self, chat: Chat):
+    async def create(self, chat: Chat):
         data = asdict(chat)
         data.pop("_id")
         data["user1"] = str(data["user1"])
         data["user2"] = str(data["user2"])
-        item = db.chats.insert_one(data)
+        item = await run("chats", lambda c: c.insert_one(data))
         chat._id = item.inserted_id
+        chat.user1 = data["user1"]
+        chat.user2 = data["user2"]
+        self._remember(chat)
+        # a new chat has no messages, so its (empty) newest page is known
+        message_cache.fill(str(chat._id), [], False, message_cache.version(str(chat._id)))
         return chat
 
-    def check_exists(self, user1: str, user2: str) -> Optional[Chat]:
-        item = db.chats.find_one({"$or": [{"user1": str(user1), "user2": str(user2)}, {"user2": str(user1), "user1": str(user2)}]})
+    async def check_exists(self, user1: str, user2: str) -> Optional[Chat]:
+        chat_id = chat_pair_cache.get(_pair(user1, user2))
+        cached = chat_cache.get(chat_id) if chat_id else None
+        if cached:
+            return replace(cached)
+        query = {"$or": [{"user1": str(user1), "user2": str(user2)}, {"user2": str(user1), "user1": str(user2)}]}
+        item = await run("chats", lambda c: c.find_one(query))
         if not item:
             return None
-        return Chat(**item)
+        chat = Chat(**item)
+        self._remember(chat)
+        return chat
+
+    def touch(self, chat_id: str, last_message: str, updated_at: datetime) -> None:
+        # keep the cached copy in step with the last_message write in MessageManager.create
+        cached = chat_cache.get(chat_id)
+        if cached and (cached.updated_at is None or cached.updated_at < updated_at):
+            cached.last_message = last_message
+            cached.updated_at = updated_at
 
 
 class MessageManager:
     def __init__(self) -> None:
         pass
 
-    def get(self, id: str) -> Optional[Message]:
-        chat = db.messages.find_one({"_id": ObjectId(id)})
+    async def get(self, id: str) -> Optional[Message]:
+        cached = message_cache.get(id)
+        if cached:
+            return cached
+        chat = await run("messages", lambda c: c.find_one({"_id": ObjectId(id)}))
         return Message(**chat) if chat else None
 
-    def create(self, message: Message):
-        data = message.to_dict()
-        item = db.messages.insert_one(data)
-        db.chats.update_one({"_id": ObjectId(message.chat)}, {"$set": {"last_message": message.text, "updated_at": datetime.now()}})
-        message._id = item.inserted_id
+    async def get_many(self, ids: Iterable[str]) -> Dict[str, Message]:
+        found = {}
+        object_ids = []
+        for id in {str(id) for id in ids}:
+            cached = message_cache.get(id)
+            if cached:
+                found[id] = cached
+            elif ObjectId.is_valid(id):
+                object_ids.append(ObjectId(id))
+        if object_ids:
+            items = await run("messages", lambda c: list(c.find({"_id": {"$in": object_ids}})))
+            found.update({str(item["_id"]): Message(**item) for item in items})
+        return found
+
+    async def create(self, message: Message, update: Optional[Update] = None):
+        """
+        Store a message, bump its chat's last_message and store `update`,
+        batched with other messages created at the same moment
+        """
+        await group_commit.submit(message, update)
         return message
 
-    def update(self, message_id: str, data: dict):
-        result: UpdateResult = db.messages.update_one({"_id": ObjectId(message_id)}, {"$set": data})
+    async def update(self, message_id: str, data: dict, chat_id: Optional[str] = None):
+        result: UpdateResult = await run("messages", lambda c: c.update_one({"_id": ObjectId(message_id)}, {"$set": data}))
+        message_cache.update(message_id, data, chat_id)
+        if MESSAGE_SEARCH and "text" in data:
+            await MessageSearchManager().update_text(message_id, data["text"])
         return result.modified_count > 0
 
-    def update_many(self, message_ids: List[str], data: dict, chat_id: Optional[str] = None,):
+    async def update_many(self, message_ids: List[str], data: dict, chat_id: Optional[str] = None,):
         object_ids = [ObjectId(mid) for mid in message_ids]
         query: dict = {"_id": {"$in": object_ids}}
         if chat_id:
             query["chat"] = chat_id
-        result: UpdateResult = db.messages.update_many(query, {"$set": data})
+        result: UpdateResult = await run("messages", lambda c: c.update_many(query, {"$set": data}))
+        for message_id in message_ids:
+            cached = message_cache.get(message_id)
+            if not chat_id or not cached or str(cached.chat) == chat_id:
+                message_cache.update(message_id, data, chat_id)
         return result.modified_count > 0
 
-    def delete(self, message_id: str) -> bool:
+    async def mark_read_until(self, chat_id: str, reader_id: str, until: Message) -> int:
+        """
+        Mark every message the other participant sent up to `until` as read,
+        with one range update over the chat's time index
+        """
+        query = {"chat": chat_id, "time": {"$lte": until.time}, "sender": {"$ne": reader_id}, "status": Message.Status.SENT.value}
+        data = {"status": Message.Status.READ.value}
+        result: UpdateResult = await run("messages", lambda c: c.update_many(query, {"$set": data}))
+        message_cache.update_chat(
+            chat_id, data, lambda message: message.time <= until.time and str(message.sender) != reader_id
+        )
+        return result.modified_count
+
+    async def delete(self, message_id: str, chat_id: Optional[str] = None) -> bool:
         id = ObjectId(message_id)
-        db.messages.delete_one({"_id": id})
+        await run("messages", lambda c: c.delete_one({"_id": id}))
+        message_cache.remove(message_id, chat_id)
+        if MESSAGE_SEARCH:
+            await MessageSearchManager().remove(message_id)
         return True
 
-    def get_chat_messages(self, chat_id: str, limit: int = 10, last_message: Optional[str] = None) -> Tuple[List[Message], bool]:
+    async def get_chat_messages(
+        self, chat_id: str, limit: int = 10, before: Optional[str] = None, after: Optional[str] = None, around: Optional[str] = None
+    ) -> Tuple[List[Message], bool, bool]:
+        """
+        Page through a chat by the (time, _id) keyset. Without a cursor returns
+        the newest page, `before`/`after` page older/newer than a message id,
+        `around` centers the page on a message. Returns messages oldest first
+        and whether older and newer messages exist
+        """
+        anchor_id = around or before or after
+        anchor = None
+        if anchor_id:
+            anchor = await self.get(anchor_id)
+            if not anchor or str(anchor.chat) != str(chat_id):
+                return [], False, False
+
+        if around:
+            older, has_more = await self._page(chat_id, limit // 2 + 1, anchor, older=True, inclusive=True)
+            newer, has_newer = await self._page(chat_id, limit - len(older), anchor, older=False)
+            return older + newer, has_more, has_newer
+        if after:
+            messages, has_newer = await self._page(chat_id, limit, anchor, older=False)
+            return messages, True, has_newer
+        if anchor is None:
+            cached = message_cache.newest(chat_id, limit)
+            if cached:
+                return cached[0], cached[1], False
+            version = message_cache.version(chat_id)
+            messages, has_more = await self._page(chat_id, limit, None, older=True)
+            message_cache.fill(chat_id, messages, has_more, version)
+            return messages, has_more, False
+        messages, has_more = await self._page(chat_id, limit, anchor, older=True)
+        return messages, has_more, True
+
+    async def _page(
+        self, chat_id: str, limit: int, anchor: Optional[Message], older: bool, inclusive: bool = False
+    ) -> Tuple[List[Message], bool]:
         query: dict = {"chat": chat_id}
-        if last_message:
-            query["_id"] = {"$lt": ObjectId(last_message)}
-        messages = db.messages.find(query).sort('time', -1).limit(limit)
+        if anchor:
+            strict, loose = ("$lt", "$lte") if older else ("$gt", "$gte")
+            query["time"] = {loose: anchor.time}
+            query["$or"] = [{"time": {strict: anchor.time}}, {"_id": {loose if inclusive else strict: ObjectId(anchor._id)}}]
+        direction = -1 if older else 1
+        sort = [("time", direction), ("_id", direction)]
+
+        # one extra row tells whether there is more past this page
+        items = await run("messages", lambda c: list(c.find(query).sort(sort).limit(limit + 1)))
+        has_more = len(items) > limit
+        messages = [Message(**item) for item in items[:limit]]
+        if older:
+            messages.reverse()
+        return messages, has_more
+
+
+class ReadMarkManager:
+    def __init__(self) -> None:
+        pass
+
+    async def advance(self, chat_id: str, user_id: str, message: Message) -> bool:
+        """
+        Move the user's read watermark in a chat forward to `message`,
+        returns False if it already was at or past it
+        """
+        key = f"{chat_id}:{user_id}"
+        data = {"chat": chat_id, "user": user_id, "message_id": str(message._id), "time": message.time}
+        result: UpdateResult = await run("read_marks", lambda c: c.update_one({"_id": key, "time": {"$lt": message.time}}, {"$set": data}))
+        if result.matched_count:
+            return True
+        try:
+            await run("read_marks", lambda c: c.insert_one({"_id": key, **data}))
+        except DuplicateKeyError:
+            return False
+        return True
 
-        messages = [Message(**message) for message in messages]
-        messages.reverse()
 
-        # know if has earlier message
-        first_message = messages[0]
-        has_earlier_message = db.messages.count_documents({"time": {"$lt": first_message.time}, "chat": first_message.chat}) > 0
+class MessageSearchManager:
+    """
+    Inverted index over message text in the message_search collection: one
+    document per message holding a "user:word" key for every participant and
+    word, indexed together with the message time
+    """
+
+    def __init__(self) -> None:
+        pass
+
+    async def add_many(self, messages: List[Message]) -> None:
+        members = {}
+        for chat_id in {str(message.chat) for message in messages}:
+            chat = await ChatManager().get(chat_id)
+            if chat:
+                members[chat_id] = [str(chat.user1), str(chat.user2)]
+        documents = [
+            {
+                "_id": message._id,
+                "chat": str(message.chat),
+                "time": message.time,
+                "users": members[str(message.chat)],
+                "keys": message_keys(message.text, members[str(message.chat)]),
+            }
+            for message in messages
+            if str(message.chat) in members
+        ]
+        if documents:
+            await run("message_search", lambda c: c.insert_many(documents))
+
+    async def update_text(self, message_id: str, text: str) -> None:
+        id = ObjectId(message_id)
+        document = await run("message_search", lambda c: c.find_one({"_id": id}, {"users": 1}))
+        if document:
+            keys = message_keys(text, document["users"])
+            await run("message_search", lambda c: c.update_one({"_id": id}, {"$set": {"keys": keys}}))
 
-        return messages, has_earlier_message
+    async def remove(self, message_id: str) -> None:
+        id = ObjectId(message_id)
+        await run("message_search", lambda c: c.delete_one({"_id": id}))
+
+    async def search(
+        self, user_id: str, q: Optional[str], chat_id: Optional[str] = None, cursor: Optional[str] = None, limit: int = 20
+    ) -> Tuple[List[Tuple[Message, Dict]], Optional[str]]:
+        """
+        Messages of the user's chats containing every word of `q`, the last one
+        as a prefix. Matches are read newest first in windows of SEARCH_SCAN and
+        ranked within a window. Returns (message, snippet) pairs and the cursor
+        of the next page, raises ValueError for a cursor it did not issue
+        """
+        words, prefix = parse_query(q)
+        if not words and not prefix:
+            return [], None
+
+        offset, anchor = self._parse_cursor(cursor)
+        keys: List = [f"{user_id}:{word}" for word in words]
+        if prefix:
+            keys.append(re.compile("^" + re.escape(f"{user_id}:{prefix}")))
+        query: dict = {"$and": [{"keys": key} for key in keys]}
+        if chat_id:
+            query["chat"] = str(chat_id)
+        if anchor:
+            anchor_time, anchor_id = anchor
+            query["$or"] = [{"time": {"$lt": anchor_time}}, {"time": anchor_time, "_id": {"$lt": anchor_id}}]
+
+        sort = [("time", -1), ("_id", -1)]
+        found = await run("message_search", lambda c: list(c.find(query, {"time": 1}).sort(sort).limit(SEARCH_SCAN)))
+        messages = await MessageManager().get_many([str(document["_id"]) for document in found])
+
+        hits = []
+        for document in found:
+            message = messages.get(str(document["_id"]))
+            if message:
+                score, snippet = match(message.text, words, prefix)
+                hits.append((score, message, snippet))
+        # found is newest first and the sort is stable, so equal scores stay newest first
+        hits.sort(key=lambda hit: -hit[0])
+
+        page = [(message, snippet) for _, message, snippet in hits[offset:offset + limit]]
+        next_cursor = None
+        if offset + limit < len(hits):
+            next_cursor = self._cursor(offset + limit, anchor)
+        elif len(found) == SEARCH_SCAN:
+            next_cursor = self._cursor(0, (found[-1]["time"], found[-1]["_id"]))
+        return page, next_cursor
+
+    @staticmethod
+    def _cursor(offset: int, anchor: Optional[Tuple[datetime, ObjectId]]) -> str:
+        if not anchor:
+            return str(offset)
+        anchor_time, anchor_id = anchor
+        return f"{offset}:{round(anchor_time.timestamp() * 1000)}:{anchor_id}"
+
+    @staticmethod
+    def _parse_cursor(cursor: Optional[str]) -> Tuple[int, Optional[Tuple[datetime, ObjectId]]]:
+        if not cursor:
+            return 0, None
+        try:
+            parts = cursor.split(":")
+            offset = int(parts[0])
+            if offset < 0 or len(parts) not in (1, 3):
+                raise ValueError(cursor)
+            if len(parts) == 1:
+                return offset, None
+            return offset, (datetime.fromtimestamp(int(parts[1]) / 1000), ObjectId(parts[2]))
+        except Exception:
+            raise ValueError(f"invalid cursor {cursor!r}")
 
 
 class UpdateManager:
     def __init__(self) -> None:
         pass
 
-    def get(self, user: str, created_at: Optional[datetime]=None) -> List[Update]:
-        query: dict = {"users": user}
-        if created_at:
+    async def get(
+        self, user: str, after_seq: Optional[int] = None, created_at: Optional[datetime] = None, limit: Optional[int] = 100
+    ) -> Tuple[List[Update], bool]:
+        """
+        Page through a user's update log in seq order, after `after_seq`
+        (or `created_at` for clients that don't track seqs yet), a `limit`
+        of None returns the whole rest of the log. Returns updates and whether more follow
+        """
+        query: dict = {"user": user}
+        if after_seq is not None:
+            query["seq"] = {"$gt": after_seq}
+        elif created_at:
             query["created_at"] = {"$gt": created_at}
 
-        updates = db.updates.find(query)
-        updates = [Update(**update) for update in updates]
-        return updates
+        # limit(0) is no limit
+        items = await run("updates", lambda c: list(c.find(query).sort("seq", 1).limit(limit + 1 if limit else 0)))
+        has_more = limit is not None and len(items) > limit
+        items = items[:limit]
+
+        if after_seq is not None:
+            # a missing seq is an update still being written by a concurrent create;
+            # stop before it so the client's cursor can't skip it, unless it is old
+            # enough that its writer must have failed
+            expected = after_seq + 1
+            for i, item in enumerate(items):
+                if item["seq"] != expected and datetime.now() - item["created_at"] < timedelta(seconds=UPDATES_GAP_GRACE):
+                    items = items[:i]
+                    has_more = True
+                    break
+                expected = item["seq"] + 1
+
+        return [
+            Update(type=item["type"], body=item["body"], users=[user], created_at=item["created_at"], _id=item["update_id"], seqs={user: item["seq"]})
+            for item in items
+        ], has_more
+
+    async def _reserve_seqs(self, user: str, count: int) -> int:
+        """
+        Reserve `count` consecutive seqs in a user's log, returns the first
+        """
+        counter = await run(
+            "counters",
+            lambda c: c.find_one_and_update({"_id": f"updates:{user}"}, {"$inc": {"seq": count}}, upsert=True, return_document=ReturnDocument.AFTER),
+        )
+        return counter["seq"] - count + 1
+
+    async def create(self, update: Update) -> Update:
+        await self.create_many([update])
+        return update
 
-    def create(self, update: Update) -> Update:
-        data = asdict(update)
-        data.pop("_id")
-        item = db.updates.insert_one(data)
-        update._id = item.inserted_id
+    async def create_many(self, updates: List[Update]) -> List[Update]:
+        """
+        Store several updates with one counter call per recipient and one
+        insert, seqs follow the order of `updates`
+        """
+        counts: Dict[str, int] = {}
+        for update in updates:
+            update.users = list(dict.fromkeys(str(user) for user in update.users))
+            for user in update.users:
+                counts[user] = counts.get(user, 0) + 1
+        firsts = await asyncio.gather(*(self._reserve_seqs(user, count) for user, count in counts.items()))
+        next_seq = dict(zip(counts, firsts))
+
+        entries = []
+        for update in updates:
+            update._id = ObjectId()  # type: ignore
+            update.seqs = {}
+            for user in update.users:
+                update.seqs[user] = next_seq[user]
+                next_seq[user] += 1
+                entries.append(
+                    {"user": user, "seq": update.seqs[user], "update_id": update._id, "type": update.type, "body": update.body, "created_at": update.created_at}
+                )
+        if entries:
+            await run("updates", lambda c: c.insert_many(entries))
+
+        for update in updates:
+            handle_update(update)
+        return updates
 
-        handle_update(update)
 
-        return update
+class GroupCommit:
+    """
+    Batches messages created within `window` seconds of each other: one
+    insert_many for the messages and one for their search entries, one bulk_write
+    for their chats' last_message and one insert for their updates. Each sender resumes
+    when its batch is committed. One batch is committed at a time, the next one
+    collects meanwhile, so batches reach the db in the order they were sent
+    """
+
+    def __init__(self, window: float, max_batch: int) -> None:
+        self.window = window
+        self.max_batch = max_batch
+        self._batch: List[Tuple[Message, Optional[Update], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._committing: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.messages = 0
+        self.largest_batch = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+
+    async def submit(self, message: Message, update: Optional[Update] = None) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((message, update, future))
+        if len(self._batch) >= self.max_batch:
+            self._commit_now()
+        elif self._timer is None and self._committing is None:
+            self._timer = loop.call_later(self.window, self._commit_now)
+        await future
+
+    def _commit_now(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        # a batch is being committed, this one goes once it is done
+        if self._committing is not None:
+            return
+        batch, self._batch = self._batch[:self.max_batch], self._batch[self.max_batch:]
+        if batch:
+            self._committing = asyncio.create_task(self._commit(batch))
+            self._committing.add_done_callback(self._committed)
+
+    def _committed(self, task: asyncio.Task) -> None:
+        self._committing = None
+        if not task.cancelled() and task.exception() is not None:
+            log.error("group commit failed", exc_info=task.exception())
+        # whatever was sent during the commit already waited, no need for another window
+        self._commit_now()
+
+    async def _commit(self, batch: List[Tuple[Message, Optional[Update], asyncio.Future]]) -> None:
+        started = time.perf_counter()
+        messages = [message for message, _, _ in batch]
+        updated_at = datetime.now()
+        last_messages = {str(message.chat): message.text for message in messages}
+        stored = chats_written = False
+        error: Optional[CommitException] = None
+        try:
+            documents = [{"_id": message._id, **message.to_dict()} for message in messages]
+            await run("messages", lambda c: c.insert_many(documents))
+            stored = True
+
+            operations = [
+                # another worker may have bumped the chat with a newer message since
+                UpdateOne(
+                    {"_id": ObjectId(chat_id), "$or": [{"updated_at": {"$lt": updated_at}}, {"updated_at": None}]},
+                    {"$set": {"last_message": text, "updated_at": updated_at}},
+                )
+                for chat_id, text in last_messages.items()
+            ]
+            await run("chats", lambda c: c.bulk_write(operations, ordered=False))
+            chats_written = True
+
+            updates = [update for _, update, _ in batch if update]
+            if updates:
+                await UpdateManager().create_many(updates)
+        except Exception:
+            log.exception("group commit failed", extra={"fields": {"messages": len(batch), "stored": stored}})
+            if stored:
+                error = CommitException("Message was saved but could not be delivered", stored=True)
+            else:
+                error = CommitException()
+
+        # the caches follow whatever reached the db
+        if stored:
+            for message in messages:
+                message_cache.add(message)
+        elif error:
+            # an insert_many failing midway may have stored part of the batch
+            for chat_id in last_messages:
+                message_cache.discard(chat_id)
+        if chats_written:
+            for chat_id, text in last_messages.items():
+                ChatManager().touch(chat_id, text, updated_at)
+
+        for _, _, future in batch:
+            if not future.done():
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+        # search is best-effort and comes after delivery, a message missing from it
+        # is picked up by --reindex-messages
+        if stored and MESSAGE_SEARCH:
+            try:
+                await MessageSearchManager().add_many(messages)
+            except Exception:
+                SEARCH_INDEX_FAILURES.inc(len(messages))
+                log.exception("search indexing failed", extra={"fields": {"messages": len(messages)}})
+        if error:
+            return
+
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.messages += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.commit_time_total += elapsed
+        self.commit_time_max = max(self.commit_time_max, elapsed)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": self.messages / self.batches if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "commit_ms_avg": self.commit_time_total / self.batches * 1000 if self.batches else 0,
+            "commit_ms_max": self.commit_time_max * 1000,
+        }
 
 
 users = UserManager()
 chats = ChatManager()
 messages = MessageManager()
 updates = UpdateManager()
+message_search = MessageSearchManager()
+read_marks = ReadMarkManager()
+group_commit = GroupCommit(GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH)
@@ -0,0 +1,163 @@
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from conf import ACTION_BURST, ACTION_RATE
+
+Handler = Callable[..., Awaitable[Any]]
+# a field's type, a tuple of accepted types, or [type] for a list of them
+Spec = Union[type, Tuple[type, ...], List[type]]
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens a second up to `burst`, each request takes one
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        0 when the request may run, otherwise seconds until a token is back
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def _checker(spec: Spec) -> Callable[[Any], Tuple[bool, Any]]:
+    if isinstance(spec, list):
+        item = _checker(spec[0])
+
+        def check_list(value):
+            if not isinstance(value, list):
+                return False, value
+            items = [item(element) for element in value]
+            return all(ok for ok, _ in items), [element for _, element in items]
+
+        return check_list
+
+    types = spec if isinstance(spec, tuple) else (spec,)
+
+    def check(value):
+        if isinstance(value, bool):
+            return bool in types, value
+        if isinstance(value, types):
+            return True, value
+        if float in types and isinstance(value, int):
+            return True, value
+        # numeric strings were accepted by the int() calls in the actions
+        if int in types and isinstance(value, str) and value.isdigit():
+            return True, int(value)
+        return False, value
+
+    return check
+
+
+def _name(spec: Spec) -> str:
+    if isinstance(spec, list):
+        plural = {str: "strings", int: "integers", float: "numbers"}
+        return f"a list of {plural.get(spec[0], _name(spec[0]))}"  # type: ignore
+    types = spec if isinstance(spec, tuple) else (spec,)
+    names = {str: "a string", int: "an integer", float: "a number", bool: "a boolean", dict: "an object", list: "a list"}
+    return " or ".join(names.get(t, t.__name__) for t in types)
+
+
+def compile_schema(schema: Dict[str, Spec]) -> Callable[[Any], Tuple[Dict, Dict]]:
+    """
+    Build the validator of an action's data once: it returns the data with
+    only the schema's fields, and the errors per field. Missing and null
+    fields are left to the action, unknown ones are dropped
+    """
+    fields = tuple((name, _checker(spec), f"{name} must be {_name(spec)}") for name, spec in schema.items())
+
+    def validate(data: Any) -> Tuple[Dict, Dict]:
+        if data is None:
+            return {}, {}
+        if not isinstance(data, dict):
+            return {}, {"message": "data must be an object"}
+        clean, errors = {}, {}
+        for name, check, message in fields:
+            value = data.get(name)
+            if value is None:
+                continue
+            ok, value = check(value)
+            if ok:
+                clean[name] = value
+            else:
+                errors[name] = message
+        return clean, errors
+
+    return validate
+
+
+class Action:
+    def __init__(self, name: str, handler: Handler, schema: Dict[str, Spec], rate: float, burst: float, concurrency: int) -> None:
+        self.name = name
+        self.handler = handler
+        self.validate = compile_schema(schema)
+        self.rate = rate
+        self.burst = burst
+        # requests of this action running across all connections, 0 for no cap
+        self.concurrency = concurrency
+        self.inflight = 0
+
+    def throttle(self, buckets: Dict[str, TokenBucket]) -> float:
+        """
+        Take a token from the connection's bucket for this action, 0 if it had one
+        """
+        if self.rate <= 0:
+            return 0.0
+        bucket = buckets.get(self.name)
+        if bucket is None:
+            bucket = buckets[self.name] = TokenBucket(self.rate, self.burst)
+        return bucket.take()
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.concurrency) and self.inflight >= self.concurrency
+
+
+class ActionTable:
+    """
+    The actions clients may call, filled by the @action decorator when the
+    actions module is imported. Nothing else in that module is reachable
+    """
+
+    def __init__(self) -> None:
+        self._actions: Dict[str, Action] = {}
+
+    def register(
+        self,
+        schema: Optional[Dict[str, Spec]] = None,
+        rate: float = ACTION_RATE,
+        burst: float = ACTION_BURST,
+        concurrency: int = 0,
+    ) -> Callable[[Handler], Handler]:
+        def decorator(func: Handler) -> Handler:
+            # ACTION_RATE=0 turns rate limiting off, per-action rates included
+            rate_limit = rate if ACTION_RATE > 0 else 0
+            self._actions[func.__name__] = Action(func.__name__, func, schema or {}, rate_limit, burst, concurrency)
+            return func
+
+        return decorator
+
+    def get(self, name: str) -> Optional[Action]:
+        return self._actions.get(name) if isinstance(name, str) else None
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def names(self) -> List[str]:
+        return sorted(self._actions)
+
+
+action_table = ActionTable()
+action = action_table.register
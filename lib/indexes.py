@@ -0,0 +1,214 @@
+import re
+import sys
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from termcolor import cprint
+
+from conf import UPDATES_TTL_DAYS
+from lib import db
+from lib.log import get_logger
+from lib.search import message_keys, name_keys
+
+log = get_logger("indexes")
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("search_keys", ASCENDING)], name="search_keys"),
+    ],
+    "chats": [
+        IndexModel([("user1", ASCENDING), ("updated_at", DESCENDING)], name="user1_updated_at"),
+        IndexModel([("user2", ASCENDING), ("updated_at", DESCENDING)], name="user2_updated_at"),
+        IndexModel([("user1", ASCENDING), ("user2", ASCENDING)], name="user1_user2"),
+    ],
+    "messages": [
+        IndexModel([("chat", ASCENDING), ("time", DESCENDING), ("_id", DESCENDING)], name="chat_time"),
+    ],
+    "message_search": [
+        IndexModel([("keys", ASCENDING), ("time", DESCENDING), ("_id", DESCENDING)], name="keys_time"),
+    ],
+    "updates": [
+        IndexModel([("user", ASCENDING), ("seq", ASCENDING)], name="user_seq", unique=True),
+        IndexModel([("user", ASCENDING), ("created_at", ASCENDING)], name="user_created_at"),
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=UPDATES_TTL_DAYS * 24 * 3600),
+    ],
+}
+
+# (collection, filter, sort) shaped like the queries the managers issue
+QUERY_PLANS: List[Tuple[str, dict, list]] = [
+    ("users", {"username": "x"}, []),
+    ("users", {"email": "x"}, []),
+    ("users", {"search_keys": {"$regex": "^x"}}, []),
+    ("chats", {"$or": [{"user1": "x"}, {"user2": "x"}]}, [("updated_at", DESCENDING)]),
+    ("chats", {"$or": [{"user1": "x", "user2": "y"}, {"user2": "x", "user1": "y"}]}, []),
+    ("messages", {"chat": "x"}, [("time", DESCENDING), ("_id", DESCENDING)]),
+    ("messages", {"chat": "x", "time": {"$lte": datetime(1970, 1, 1)}, "sender": {"$ne": "x"}, "status": "sent"}, []),
+    (
+        "messages",
+        {"chat": "x", "time": {"$lte": datetime(1970, 1, 1)}, "$or": [{"time": {"$lt": datetime(1970, 1, 1)}}, {"_id": {"$lt": ObjectId()}}]},
+        [("time", DESCENDING), ("_id", DESCENDING)],
+    ),
+    ("message_search", {"$and": [{"keys": "x:y"}, {"keys": "x:z"}]}, [("time", DESCENDING), ("_id", DESCENDING)]),
+    ("message_search", {"$and": [{"keys": "x:y"}, {"keys": re.compile("^x:z")}]}, [("time", DESCENDING), ("_id", DESCENDING)]),
+    ("updates", {"user": "x", "seq": {"$gt": 0}}, [("seq", ASCENDING)]),
+    ("updates", {"user": "x", "created_at": {"$gt": datetime(1970, 1, 1)}}, [("seq", ASCENDING)]),
+]
+
+
+def ensure_indexes(database: Database = db.db) -> List[str]:
+    """
+    Create every declared index that is missing, returns the names created
+    """
+    created = []
+    for collection, models in missing_indexes(database).items():
+        for model in models:
+            try:
+                database[collection].create_indexes([model])
+                created.append(f"{collection}.{model.document['name']}")
+            except OperationFailure as e:
+                log.warning(f"could not create index {collection}.{model.document['name']}: {e}")
+    return created
+
+
+def missing_indexes(database: Database = db.db) -> Dict[str, List[IndexModel]]:
+    missing = {}
+    for collection, models in INDEXES.items():
+        existing = set(database[collection].index_information())
+        absent = [model for model in models if model.document["name"] not in existing]
+        if absent:
+            missing[collection] = absent
+    return missing
+
+
+def backfill_search_keys(database: Database = db.db) -> int:
+    """
+    Set search_keys on users written before it existed, returns how many were updated
+    """
+    updated = 0
+    operations = []
+    for user in database.users.find({"search_keys": {"$exists": False}}, {"username": 1, "full_name": 1}):
+        keys = name_keys(user["username"], user.get("full_name"))
+        operations.append(UpdateOne({"_id": user["_id"]}, {"$set": {"search_keys": keys}}))
+        if len(operations) == 1000:
+            database.users.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    if operations:
+        database.users.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    return updated
+
+
+def migrate_updates(database: Database = db.db) -> int:
+    """
+    Split updates stored before per-user logs, one document with a `users`
+    array, into an entry per recipient with the next seqs of their log.
+    Runs before ensure_indexes, user_seq can't be built while they remain.
+    Returns how many were split
+    """
+    migrated = 0
+    while True:
+        legacy = list(database.updates.find({"users": {"$exists": True}}).sort([("created_at", ASCENDING), ("_id", ASCENDING)]).limit(1000))
+        if not legacy:
+            return migrated
+        counts: Dict[str, int] = {}
+        for update in legacy:
+            update["users"] = list(dict.fromkeys(str(user) for user in update["users"]))
+            for user in update["users"]:
+                counts[user] = counts.get(user, 0) + 1
+        # the same counters UpdateManager reserves seqs from
+        next_seq = {}
+        for user, count in counts.items():
+            counter = database.counters.find_one_and_update(
+                {"_id": f"updates:{user}"}, {"$inc": {"seq": count}}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+            next_seq[user] = counter["seq"] - count + 1
+        entries = []
+        for update in legacy:
+            for user in update["users"]:
+                entries.append(
+                    {"user": user, "seq": next_seq[user], "update_id": update["_id"], "type": update["type"], "body": update["body"], "created_at": update["created_at"]}
+                )
+                next_seq[user] += 1
+        if entries:
+            database.updates.insert_many(entries)
+        database.updates.delete_many({"_id": {"$in": [update["_id"] for update in legacy]}})
+        migrated += len(legacy)
+
+
+def reindex_messages(database: Database = db.db) -> int:
+    """
+    Rebuild the message_search entries of every message, chat by chat,
+    returns how many were written
+    """
+    written = 0
+    for chat in database.chats.find({}, {"user1": 1, "user2": 1}):
+        users = [str(chat["user1"]), str(chat["user2"])]
+        operations = []
+        for message in database.messages.find({"chat": str(chat["_id"])}, {"text": 1, "time": 1}):
+            document = {"chat": str(chat["_id"]), "time": message["time"], "users": users, "keys": message_keys(message["text"], users)}
+            operations.append(UpdateOne({"_id": message["_id"]}, {"$set": document}, upsert=True))
+            if len(operations) == 1000:
+                database.message_search.bulk_write(operations, ordered=False)
+                written += len(operations)
+                operations = []
+        if operations:
+            database.message_search.bulk_write(operations, ordered=False)
+            written += len(operations)
+    return written
+
+
+def _stages(plan: dict):
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _stages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        yield from _stages(stage)
+
+
+def collection_scans(database: Database = db.db) -> List[str]:
+    """
+    Explain every query in QUERY_PLANS and return the ones whose winning plan
+    falls back to a collection scan
+    """
+    scans = []
+    for collection, query, sort in QUERY_PLANS:
+        cursor = database[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _stages(plan):
+            scans.append(f"{collection} {query} sort={sort}")
+    return scans
+
+
+if __name__ == "__main__":
+    # python -m lib.indexes [--check | --reindex-messages]
+    if "--check" in sys.argv:
+        missing = missing_indexes()
+        for collection, models in missing.items():
+            for model in models:
+                cprint(f"missing {collection}.{model.document['name']}", "yellow")
+        scans = collection_scans()
+        for scan in scans:
+            cprint(f"COLLSCAN {scan}", "red")
+        sys.exit(1 if missing or scans else 0)
+
+    if "--reindex-messages" in sys.argv:
+        cprint(f"indexed {reindex_messages()} messages for search", "green")
+        sys.exit(0)
+
+    split = migrate_updates()
+    if split:
+        cprint(f"split {split} updates into per-user logs", "green")
+    for name in ensure_indexes():
+        cprint(f"created {name}", "green")
+    backfilled = backfill_search_keys()
+    if backfilled:
+        cprint(f"set search_keys on {backfilled} users", "green")
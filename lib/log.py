@@ -0,0 +1,138 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+
+from conf import LOG_FILE, LOG_FORMAT, LOG_LEVEL, LOG_MAX_FIELD, LOG_MAX_PAYLOAD, LOG_SAMPLE
+
+# request and response fields never written out
+REDACTED = {"password", "access_token", "refresh_token", "access", "refresh", "token"}
+
+_listeners: List[QueueListener] = []
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"chat.{name}")
+
+
+def redact(value: Any, max_field: int = LOG_MAX_FIELD) -> Any:
+    """
+    Copy of a request or response body with secrets masked and long strings cut
+    """
+    if isinstance(value, dict):
+        return {key: "***" if key in REDACTED else redact(item, max_field) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item, max_field) for item in value]
+    if isinstance(value, str) and len(value) > max_field:
+        return f"{value[:max_field]}...(+{len(value) - max_field})"
+    return value
+
+
+def payload(value: Any) -> str:
+    text = json.dumps(redact(value), default=str, ensure_ascii=False)
+    if len(text) > LOG_MAX_PAYLOAD:
+        text = f"{text[:LOG_MAX_PAYLOAD]}...(+{len(text) - LOG_MAX_PAYLOAD})"
+    return text
+
+
+class Sampler:
+    """
+    Keeps one in `rates[action]` events of an action, every event of the others
+    """
+
+    def __init__(self, rates: Dict[str, int]) -> None:
+        self.rates = rates
+        self._seen: Dict[str, int] = {}
+
+    def keep(self, action: Optional[str]) -> bool:
+        rate = self.rates.get(action or "", 1)
+        if rate <= 1:
+            return True
+        seen = self._seen.get(action, 0) + 1  # type: ignore
+        self._seen[action] = seen  # type: ignore
+        return seen % rate == 1
+
+
+class Formatter(logging.Formatter):
+    """
+    One line per record, the `fields` passed as extra appended as key=value
+    pairs, or the whole record as a json object
+    """
+
+    def __init__(self, json_lines: bool = False) -> None:
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        if self.json_lines:
+            line = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "message": record.getMessage(), **fields}
+            if record.exc_text:
+                line["exc"] = record.exc_text
+            return json.dumps(line, default=str, ensure_ascii=False)
+        text = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_text:
+            text += "\n" + record.exc_text
+        return text
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the traceback is rendered here, where it is still live, but kept
+        # apart from the message so the formatter can place it
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def queued(handler: logging.Handler) -> QueueHandler:
+    """
+    A handler that only puts records on a queue, `handler` writes them from a listener thread
+    """
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return _QueueHandler(records)  # type: ignore
+
+
+def setup_logging(level: str = LOG_LEVEL, format: str = LOG_FORMAT, path: str = LOG_FILE) -> None:
+    """
+    Route the "chat" loggers through a queue to stdout or `path`, once per process
+    """
+    logger = logging.getLogger("chat")
+    if logger.handlers:
+        return
+    target = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+    target.setFormatter(Formatter(json_lines=format == "json"))
+    logger.addHandler(queued(target))
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+
+@atexit.register
+def _flush() -> None:
+    for listener in _listeners:
+        listener.stop()
+
+
+def _rates(spec: str) -> Dict[str, int]:
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            action, rate = item.split("=", 1)
+            rates[action.strip()] = int(rate)
+    return rates
+
+
+frames = Sampler(_rates(LOG_SAMPLE))
@@ -0,0 +1,155 @@
+import asyncio
+from bisect import bisect_left
+from urllib.parse import parse_qsl, urlsplit
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# seconds, from a cache hit to a request stuck behind a stalled peer
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, *labels) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count per label values, as prometheus expects them
+    """
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: [count per bucket..., overflow], sum
+        self._values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    Read when scraped: `read` returns a number, or for a gauge with one label
+    a dict of label value to number, e.g. one of the existing stats() dicts
+    """
+
+    def __init__(self, name: str, help: str, read: Callable[[], Union[float, Dict[str, float]]], label: Optional[str] = None) -> None:
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.read()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if isinstance(item, (int, float)):
+                    lines.append(f'{self.name}{{{self.label or "key"}="{key}"}} {item}')
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Union[Counter, Histogram, Gauge]] = {}
+        # other local endpoints: path -> handler of the query parameters, ValueError answers 400
+        self._routes: Dict[str, Callable[[Dict[str, str]], str]] = {}
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))  # type: ignore
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))  # type: ignore
+
+    def gauge(self, name: str, help: str, read: Callable, label: Optional[str] = None) -> Gauge:
+        # a later gauge of the same name replaces the earlier one, e.g. for a new Server
+        return self._add(Gauge(name, help, read, label))  # type: ignore
+
+    def route(self, path: str, handler: Callable[[Dict[str, str]], str]) -> None:
+        self._routes[path] = handler
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """
+        Answer GET /metrics in the prometheus text format and the registered
+        routes, anything else with 404
+        """
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+                target = request.decode("latin-1").split(" ", 2)[1] if request.count(b" ") >= 2 else ""
+                url = urlsplit(target)
+                if url.path == "/metrics":
+                    status, body = "200 OK", self.render().encode()
+                elif url.path in self._routes:
+                    try:
+                        status, body = "200 OK", (self._routes[url.path](dict(parse_qsl(url.query))) + "\n").encode()
+                    except ValueError as e:
+                        status, body = "400 Bad Request", f"{e}\n".encode()
+                else:
+                    status, body = "404 Not Found", b"not found\n"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+metrics = Metrics()
@@ -0,0 +1,50 @@
+import asyncio
+from typing import Awaitable, Dict, List, Optional, Set
+
+
+class Pipeline:
+    """
+    Runs one connection's requests concurrently, up to `limit` at a time.
+    Requests sharing a key run in arrival order, a barrier request waits
+    for everything before it and holds back everything after it
+    """
+
+    def __init__(self, limit: int) -> None:
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks: Set[asyncio.Task] = set()
+        self._tails: Dict[str, asyncio.Task] = {}
+        self._barrier: Optional[asyncio.Task] = None
+
+    async def submit(self, request: Awaitable, key: Optional[str] = None, barrier: bool = False) -> None:
+        # blocks the reader once `limit` requests are in flight
+        await self._slots.acquire()
+
+        after: List[asyncio.Task] = []
+        if barrier:
+            after.extend(self._tasks)
+        else:
+            if self._barrier and not self._barrier.done():
+                after.append(self._barrier)
+            if key is not None and key in self._tails:
+                after.append(self._tails[key])
+
+        task = asyncio.create_task(self._run(request, after))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if barrier:
+            self._barrier = task
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda t: self._tails.pop(key, None) if self._tails.get(key) is t else None)
+
+    async def _run(self, request: Awaitable, after: List[asyncio.Task]) -> None:
+        try:
+            if after:
+                await asyncio.wait(after)
+            await request
+        finally:
+            self._slots.release()
+
+    async def join(self) -> None:
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
@@ -0,0 +1,199 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional, Set
+
+from pymongo import monitoring
+
+from conf import PROFILE_ACTIONS, PROFILE_SAMPLE, SLOW_ACTION_SECONDS, SLOW_LOG, SLOW_LOG_BACKUPS, SLOW_LOG_MAX_BYTES
+from lib.log import queued
+from lib.metrics import metrics
+
+# command fields that say nothing about the query
+_NOISE = {"lsid", "$db", "$clusterTime", "txnNumber", "$readPreference", "signature"}
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("profile_trace", default=None)
+# the trace of the request a db executor thread is running a call for
+_local = threading.local()
+
+
+class Trace:
+    """
+    What one profiled request did: its cProfile, when it got the profiler,
+    and every mongo command its db calls issued
+    """
+
+    def __init__(self, action: str, profile: Optional[cProfile.Profile]) -> None:
+        self.action = action
+        self.profile = profile
+        self.queries: List[Dict] = []
+        self._pending: Dict[int, Dict] = {}
+        self.token: Optional[Token] = None
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def traced(trace: Optional[Trace], method: str):
+    """
+    Attribute the mongo commands issued in this thread to `trace`, until exit
+    """
+    if trace is None:
+        yield
+        return
+    _local.trace, _local.method = trace, method
+    try:
+        yield
+    finally:
+        _local.trace = None
+
+
+def _summary(command: dict) -> str:
+    text = json.dumps({key: value for key, value in command.items() if key not in _NOISE}, default=str)
+    return text if len(text) <= 500 else text[:500] + "..."
+
+
+class QueryListener(monitoring.CommandListener):
+    """
+    Records the commands of traced db calls, a no-op for everything else
+    """
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace._pending[event.request_id] = {
+                "method": _local.method,
+                "command": event.command_name,
+                "query": _summary(event.command),
+            }
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, True)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, False)
+
+    def _finish(self, event, ok: bool) -> None:
+        trace = getattr(_local, "trace", None)
+        query = trace._pending.pop(event.request_id, None) if trace is not None else None
+        if query is not None:
+            trace.queries.append({**query, "ms": event.duration_micros / 1000, "ok": ok})
+
+
+class Profiler:
+    """
+    Profiles every request of the `actions` set and one in `sample` of the
+    rest. Profiled requests slower than `threshold` seconds are written to
+    the slow log as one json object per line.
+
+    cProfile sees the whole event loop, so a profile also holds whatever other
+    requests ran meanwhile, and only one request is profiled at a time: others
+    selected while it runs record their queries only
+    """
+
+    def __init__(self, sample: int, actions: Set[str], threshold: float, path: str, max_bytes: int, backups: int) -> None:
+        self.sample = sample
+        self.actions = actions
+        self.threshold = threshold
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self._seen = 0
+        self._busy = False
+        self._log: Optional[logging.Logger] = None
+
+    def configure(self, sample: Optional[int] = None, actions: Optional[Set[str]] = None, threshold: Optional[float] = None) -> Dict:
+        if sample is not None:
+            self.sample = max(sample, 0)
+        if actions is not None:
+            self.actions = actions
+        if threshold is not None:
+            self.threshold = threshold
+        return self.settings()
+
+    def settings(self) -> Dict:
+        return {"sample": self.sample, "actions": sorted(self.actions), "threshold": self.threshold, "path": self.path, "written": self.written}
+
+    def begin(self, action: str) -> Optional[Trace]:
+        if action not in self.actions:
+            if not self.sample:
+                return None
+            self._seen += 1
+            if self._seen % self.sample:
+                return None
+
+        profile = None
+        if not self._busy:
+            self._busy = True
+            profile = cProfile.Profile()
+            profile.enable()
+        trace = Trace(action, profile)
+        trace.token = _current.set(trace)
+        return trace
+
+    def end(self, trace: Trace, elapsed: float, outcome: str, user_id: Optional[str] = None, fields: Optional[List[str]] = None) -> None:
+        if trace.profile:
+            trace.profile.disable()
+            self._busy = False
+        if trace.token:
+            _current.reset(trace.token)
+        if elapsed < self.threshold:
+            return
+
+        record = {
+            "time": datetime.now().isoformat(),
+            "action": trace.action,
+            "ms": round(elapsed * 1000, 3),
+            "outcome": outcome,
+            "user": user_id,
+            # only the field names, values may be passwords or tokens
+            "fields": fields or [],
+            "db_ms": round(sum(query["ms"] for query in trace.queries), 3),
+            "queries": trace.queries,
+            "profile": self._stats(trace.profile) if trace.profile else None,
+        }
+        self._logger().info(json.dumps(record, default=str))
+        self.written += 1
+
+    @staticmethod
+    def _stats(profile: cProfile.Profile) -> str:
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).strip_dirs().sort_stats("cumulative").print_stats(30)
+        return out.getvalue()
+
+    def _logger(self) -> logging.Logger:
+        if self._log is None:
+            self._log = logging.getLogger("chat.slow")
+            self._log.propagate = False
+            self._log.setLevel(logging.INFO)
+            handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            # written from the listener thread, a rotation never stalls the loop
+            self._log.addHandler(queued(handler))
+        return self._log
+
+
+profiler = Profiler(PROFILE_SAMPLE, PROFILE_ACTIONS, SLOW_ACTION_SECONDS, SLOW_LOG, SLOW_LOG_MAX_BYTES, SLOW_LOG_BACKUPS)
+query_listener = QueryListener()
+
+
+def _configure(query: Dict[str, str]) -> str:
+    # /profile?sample=100&actions=get_chats,get_messages&threshold=0.25, without arguments shows the settings
+    actions = {action for action in query["actions"].split(",") if action} if "actions" in query else None
+    sample = int(query["sample"]) if "sample" in query else None
+    threshold = float(query["threshold"]) if "threshold" in query else None
+    return json.dumps(profiler.configure(sample, actions, threshold))
+
+
+metrics.route("/profile", _configure)
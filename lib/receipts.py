@@ -0,0 +1,59 @@
+import asyncio
+from typing import Dict, Set, Tuple
+
+from conf import READ_DEBOUNCE
+from lib import db
+from lib.log import get_logger
+
+log = get_logger("receipts")
+
+
+class ReadReceipts:
+    """
+    Debounces "read up to" calls per (chat, reader): calls arriving within
+    `window` seconds of the first only move the pending watermark, then one
+    range update and one receipt go out for the furthest message
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._pending: Dict[Tuple[str, str], Tuple[db.Chat, db.Message]] = {}
+        # flushes waiting out their window, referenced until done so they aren't garbage collected
+        self._tasks: Set[asyncio.Task] = set()
+        self.coalesced = 0
+
+    def mark(self, chat: db.Chat, reader_id: str, message: db.Message) -> None:
+        key = (str(chat._id), reader_id)
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = (chat, message)
+            task = asyncio.create_task(self._flush(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+        self.coalesced += 1
+        if (message.time, str(message._id)) > (pending[1].time, str(pending[1]._id)):
+            self._pending[key] = (chat, message)
+
+    async def _flush(self, key: Tuple[str, str]) -> None:
+        await asyncio.sleep(self.window)
+        chat, message = self._pending.pop(key)
+        chat_id, reader_id = key
+
+        # nobody awaits this task, a failure would otherwise vanish
+        try:
+            if not await db.read_marks.advance(chat_id, reader_id, message):
+                return
+            await db.messages.mark_read_until(chat_id, reader_id, message)
+
+            body = {"chat_id": chat_id, "up_to": str(message._id), "message_ids": [], "status": "read"}
+            update = db.Update(type="read_message", body=body, users=[chat.other_user_id(reader_id)])
+            await db.updates.create(update)
+        except Exception:
+            log.exception("read receipt failed", extra={"fields": {"chat": chat_id, "reader": reader_id, "up_to": str(message._id)}})
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._pending), "coalesced": self.coalesced}
+
+
+read_receipts = ReadReceipts(READ_DEBOUNCE)
@@ -0,0 +1,61 @@
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+
+class ConnectionRegistry:
+    """
+    Live connections indexed by user id, kept in sync on authenticate/disconnect.
+    `on_join`/`on_leave` are called when a user's first connection arrives
+    and when their last one goes
+    """
+
+    def __init__(
+        self, on_join: Optional[Callable[[str], None]] = None, on_leave: Optional[Callable[[str], None]] = None
+    ) -> None:
+        self._by_user: Dict[str, Set] = {}
+        self._user_of: Dict[object, str] = {}
+        self.on_join = on_join
+        self.on_leave = on_leave
+
+    def add(self, conn) -> None:
+        if not conn.user:
+            return
+        user_id = str(conn.user._id)
+        previous = self._user_of.get(conn)
+        if previous == user_id:
+            return
+        if previous is not None:
+            self.remove(conn)
+        if user_id not in self._by_user:
+            self._by_user[user_id] = set()
+            if self.on_join:
+                self.on_join(user_id)
+        self._by_user[user_id].add(conn)
+        self._user_of[conn] = user_id
+
+    def remove(self, conn) -> Optional[str]:
+        user_id = self._user_of.pop(conn, None)
+        if user_id is None:
+            return None
+        conns = self._by_user.get(user_id)
+        if conns is not None:
+            conns.discard(conn)
+            if not conns:
+                del self._by_user[user_id]
+                if self.on_leave:
+                    self.on_leave(user_id)
+        return user_id
+
+    def get(self, user_id: str) -> List:
+        return [conn for conn in self._by_user.get(str(user_id), ()) if conn.is_open]
+
+    def is_online(self, user_id: str) -> bool:
+        return any(conn.is_open for conn in self._by_user.get(str(user_id), ()))
+
+    def online(self, user_ids: Iterable[str]) -> Set[str]:
+        return {str(user_id) for user_id in user_ids if self.is_online(user_id)}
+
+    def users(self) -> List[str]:
+        return list(self._by_user)
+
+    def __len__(self) -> int:
+        return len(self._user_of)
@@ -0,0 +1,185 @@
+import math
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# words indexed per message, and the shortest last query word matched as a prefix
+MAX_TERMS = 64
+PREFIX_MIN = 3
+# characters of context returned around the first match
+SNIPPET_WIDTH = 120
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text: Optional[str]) -> str:
+    """
+    Case and accent folded text with whitespace collapsed, so "  José " matches "jose"
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(text.casefold().split())
+
+
+def name_keys(username: str, full_name: Optional[str] = None) -> List[str]:
+    """
+    Normalized strings a user can be found by prefix of: the username,
+    the full name and every later word of the full name
+    """
+    keys = [normalize(username)]
+    full = normalize(full_name)
+    if full:
+        keys.append(full)
+        keys.extend(full.split(" ")[1:])
+    return list(dict.fromkeys(key for key in keys if key))
+
+
+def rank(q: str, username: str, full: str) -> Tuple[int, int, str]:
+    """
+    Sort key of a match, all arguments normalized: exact match first,
+    then username prefix, full name prefix, and a later word of the full name
+    """
+    if q == username or q == full:
+        tier = 0
+    elif username.startswith(q):
+        tier = 1
+    elif full.startswith(q):
+        tier = 2
+    else:
+        tier = 3
+    return (tier, len(username), username)
+
+
+class PrefixIndex:
+    """
+    In-memory sorted list of (key, id) pairs over users' name keys,
+    answering prefix queries with a binary search
+    """
+
+    def __init__(self) -> None:
+        self._keys: List[Tuple[str, str]] = []
+        # normalized (username, full name) by id
+        self._names: Dict[str, Tuple[str, str]] = {}
+
+    def load(self, users: Iterable[Tuple[str, str, Optional[str]]]) -> None:
+        """
+        Replace the contents with (id, username, full_name) rows, sorting once
+        """
+        self._names = {id: (normalize(username), normalize(full_name)) for id, username, full_name in users}
+        self._keys = sorted((key, id) for id, names in self._names.items() for key in name_keys(*names))
+
+    def add(self, id: str, username: str, full_name: Optional[str] = None) -> None:
+        names = (normalize(username), normalize(full_name))
+        if self._names.get(id) == names:
+            return
+        self.remove(id)
+        self._names[id] = names
+        for key in name_keys(*names):
+            insort(self._keys, (key, id))
+
+    def remove(self, id: str) -> None:
+        names = self._names.pop(id, None)
+        if names is None:
+            return
+        for key in name_keys(*names):
+            position = bisect_left(self._keys, (key, id))
+            if position < len(self._keys) and self._keys[position] == (key, id):
+                del self._keys[position]
+
+    def search(self, q: str, scan: int) -> List[str]:
+        """
+        Ids of up to `scan` users with a key starting with the normalized `q`, best ranked first
+        """
+        found: Dict[str, None] = {}
+        position = bisect_left(self._keys, (q,))
+        while position < len(self._keys) and len(found) < scan:
+            key, id = self._keys[position]
+            if not key.startswith(q):
+                break
+            found[id] = None
+            position += 1
+        return sorted(found, key=lambda id: rank(q, *self._names[id]))
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+def terms(text: Optional[str]) -> List[str]:
+    """
+    Distinct normalized words of `text`, in order, at most MAX_TERMS
+    """
+    return list(dict.fromkeys(_WORD.findall(normalize(text))))[:MAX_TERMS]
+
+
+def message_keys(text: str, users: Iterable[str]) -> List[str]:
+    """
+    Inverted index keys of a message: one "user:word" per participant and word,
+    so a lookup only ever reaches the searching user's chats
+    """
+    words = terms(text)
+    return [f"{user}:{word}" for user in users for word in words]
+
+
+def parse_query(q: Optional[str]) -> Tuple[List[str], Optional[str]]:
+    """
+    Split a query into words that must match exactly and a trailing prefix,
+    the last word while it is still being typed
+    """
+    words = terms(q)
+    if words and q and not q[-1].isspace() and len(words[-1]) >= PREFIX_MIN:
+        return words[:-1], words[-1]
+    return words, None
+
+
+def _fold(text: str) -> Tuple[str, List[int]]:
+    # normalized text and, for every character of it, its index in `text`
+    chars: List[str] = []
+    origin: List[int] = []
+    for i, char in enumerate(text):
+        for part in unicodedata.normalize("NFKD", char):
+            if unicodedata.combining(part):
+                continue
+            for folded in part.casefold():
+                chars.append(folded)
+                origin.append(i)
+    return "".join(chars), origin
+
+
+def match(text: str, words: List[str], prefix: Optional[str]) -> Tuple[float, Dict]:
+    """
+    Score `text` against a parsed query and cut a snippet around the first hit.
+    Repeated words add less than distinct ones, exact words more than the prefix,
+    and the query's words appearing in order add a bonus
+    """
+    folded, origin = _fold(text)
+    tokens = [(token.group(), token.start(), token.end()) for token in _WORD.finditer(folded)]
+
+    score = 0.0
+    spans = []
+    counts: Dict[str, int] = {}
+    for token, start, end in tokens:
+        if token in words:
+            counts[token] = counts.get(token, 0) + 1
+        elif prefix and token.startswith(prefix):
+            counts[prefix] = counts.get(prefix, 0) + 1
+        else:
+            continue
+        spans.append((origin[start], origin[end - 1] + 1))
+    for word, count in counts.items():
+        score += (1 + math.log(count)) * (0.5 if word == prefix else 1.0)
+    query = " ".join(words + ([prefix] if prefix else []))
+    if len(words) + bool(prefix) > 1 and query in " ".join(token for token, _, _ in tokens):
+        score += 1.0
+
+    first = spans[0][0] if spans else 0
+    start = max(0, min(first - SNIPPET_WIDTH // 3, len(text) - SNIPPET_WIDTH))
+    end = start + SNIPPET_WIDTH
+    snippet = {
+        "text": text[start:end],
+        "start": start,
+        "highlights": [[a - start, b - start] for a, b in spans if a >= start and b <= end],
+    }
+    return score, snippet
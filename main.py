@@ -1,162 +1,315 @@
 import asyncio
 import json
-import traceback
+import logging
+import multiprocessing
+import time
 from datetime import datetime
-from typing import List, Optional
+from typing import Iterable, List, Optional, Set, Tuple
 
 import websockets
-from termcolor import colored, cprint
 
 import actions
-from conf import BIND_HOST, BIND_PORT
+from conf import BIND_HOST, BIND_PORT, MAX_INFLIGHT, METRICS_HOST, METRICS_PORT, SEND_TIMEOUT, UPDATE_BUS, WORKERS
 from lib import db
+from lib.bus import create_bus
 from lib.connection import Connection
+from lib.dispatch import action_table
+from lib.indexes import backfill_search_keys, ensure_indexes, migrate_updates
+from lib.log import frames, get_logger, payload, setup_logging
+from lib.metrics import metrics
+from lib.pipeline import Pipeline
+from lib.profiling import profiler
+from lib.receipts import read_receipts
+from lib.registry import ConnectionRegistry
+from utils import crypt
+from utils.exceptions import BusyException
 from utils.server_holder import use_server
 
 
+log = get_logger("server")
+
+# actions that change who the connection is, they run alone in the pipeline
+BARRIER_ACTIONS = {"login", "sign_up", "authenticate", "update_user", "refresh_access_token"}
+
+ACTION_SECONDS = metrics.histogram("chat_action_seconds", "Time from dispatch to the response being queued", ("action",))
+ACTIONS = metrics.counter("chat_actions_total", "Dispatched requests by outcome: ok, failed, error, invalid, throttled, busy or unknown", ("action", "outcome"))
+FANOUT_SECONDS = metrics.histogram("chat_fanout_seconds", "Time to queue an update for every connection of its recipients", ("type",))
+FANOUT_FRAMES = metrics.counter("chat_fanout_frames_total", "Update frames by whether the recipient connection took them", ("result",))
+
+
+def ordering_key(action: str, data: dict) -> Optional[str]:
+    """
+    Requests with the same key run in the order they arrived: writes to
+    one chat, or to one message when the chat isn't given
+    """
+    if not isinstance(data, dict):
+        return None
+    if action in ("new_message", "read_message"):
+        return f"chat:{data.get('chat_id') or data.get('user_id')}"
+    if action in ("edit_message", "delete_message"):
+        return f"chat:{data['chat_id']}" if data.get("chat_id") else f"message:{data.get('message_id')}"
+    return None
+
+
 class Server:
-    def __init__(self, host, port):
-        self.client_list: List[Connection] = []
+    def __init__(
+        self, host, port, bus_kind: str = UPDATE_BUS, reuse_port: bool = False, metrics_port: int = METRICS_PORT
+    ):
+        self.clients: Set[Connection] = set()
+        self.bus = create_bus(self.handle_update, self.handle_frame, bus_kind)
+        # a worker only hears about updates for users connected to it
+        self.registry = ConnectionRegistry(on_join=self.bus.subscribe, on_leave=self.bus.unsubscribe)
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port
+        self.metrics_port = metrics_port
+
+        metrics.gauge("chat_connections", "Open websocket connections", lambda: len(self.clients))
+        metrics.gauge("chat_connections_authenticated", "Connections with a logged in user", lambda: len(self.registry))
+        metrics.gauge("chat_users_online", "Users with at least one connection", lambda: len(self.registry.users()))
+        metrics.gauge("chat_outbound", "Outbound queues: frames queued, deepest queue, dropped and coalesced", self.outbound_stats)
+        metrics.gauge("chat_group_commit", "Message group commit batches", db.group_commit.stats)
+        metrics.gauge("chat_read_receipts", "Debounced read receipts: waiting to flush and coalesced into one", read_receipts.stats)
+        metrics.gauge("chat_crypt", "Password hashing pool", lambda: crypt.crypt_stats)
+        metrics.gauge("chat_message_cache", "Cached newest messages per chat", db.message_cache.stats)
+        metrics.gauge("chat_user_cache", "Cached users", db.user_cache.stats)
+        metrics.gauge("chat_chat_cache", "Cached chats", db.chat_cache.stats)
 
     async def handler(self, websocket):
-        conn = Connection(websocket, websocket.remote_address)
-        self.client_list.append(conn)
-        cprint("client connected", "green")
+        conn = Connection(websocket, websocket.remote_address, self.registry)
+        conn.start()
+        self.clients.add(conn)
+        log.debug("client connected", extra={"fields": {"addr": conn.addr}})
+        pipeline = Pipeline(MAX_INFLIGHT)
         try:
             async for message in websocket:
-                await self.on_message(message, conn)
+                request = self.parse(message)
+                if request:
+                    action, data = request
+                    await pipeline.submit(
+                        self.dispatch(action, data, conn), key=ordering_key(action, data), barrier=action in BARRIER_ACTIONS
+                    )
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
+            await pipeline.join()
             await self.remove_conn(conn)
 
     async def remove_conn(self, connection: Connection):
-        if connection in self.client_list:
+        if connection in self.clients:
+            connection.stop()
+            self.clients.discard(connection)
+            self.registry.remove(connection)
             if connection.user:
                 connection.user.last_seen = datetime.now()
-                db.users.update(connection.user._id, connection.user)
-                chats = db.chats.get_user_chats(str(connection.user._id))
-                for chat in chats:
-                    user_to_notify = None
-                    if chat.user1 == str(connection.user._id): # type: ignore
-                        user_to_notify = chat.user2
-                    elif chat.user2 == str(connection.user._id): # type: ignore
-                        user_to_notify = chat.user1
-
-                    if user_to_notify:
-                        connections = [connection for connection in self.client_list if connection.user and str(connection.user._id) == user_to_notify]
-                        for conn in connections:
-                            data = {"action": "status_change", "success": True, "data": {"user_id": str(connection.user._id), "status": "offline", "last_seen": datetime.now().timestamp()}} # type: ignore
-                            await self.send_message(conn, data)
-
-            self.client_list.remove(connection)
+                await db.users.update(connection.user._id, connection.user)
+                user_id = str(connection.user._id)
+                # other tabs/devices of the same user keep them online, on any worker
+                if not await self.is_online(user_id):
+                    await self.notify_status(user_id, "offline")
 
-    async def send_message(self, conn, body: dict, additional_data: Optional[dict] = {}):
-        if body.get('action', '') == "get_chats":
-            for chat in body.get("data", {}).get("results", []):
-                if chat and chat.get("user", {}).get("id"):
-                    online_users = await self.find_online_user(chat["user"]["id"])
-                    chat["user"]["is_online"] = any(online_users)
+    async def notify_status(self, user_id: str, status: str):
+        chats = await db.chats.get_user_chats(user_id)
+        partners = set()
+        for chat in chats:
+            if chat.user1 == user_id:
+                partners.add(chat.user2)
+            elif chat.user2 == user_id:
+                partners.add(chat.user1)
+
+        data = {"action": "status_change", "success": True, "data": {"user_id": user_id, "status": status, "last_seen": datetime.now().timestamp()}}
+        # through the bus, partners may be connected to other workers
+        await self.bus.publish_frame(partners, json.dumps(data), key=f"status:{user_id}")
+
+    async def handle_frame(self, user_ids: List[str], data: str, key: Optional[str] = None):
+        # only the latest status of a user matters, so queued ones are replaced or dropped first
+        await self.broadcast(self.connections_of(user_ids), data, key=key, ephemeral=True)
+
+    async def online(self, user_ids: Iterable[str]) -> Set[str]:
+        """
+        The users of `user_ids` with a connection to this or any other worker
+        """
+        user_ids = {str(user_id) for user_id in user_ids}
+        local = self.registry.online(user_ids)
+        rest = user_ids - local
+        return local | await self.bus.online(rest) if rest else local
 
-        elif body.get('action', '') == "authenticate" and body.get("success"):
+    async def is_online(self, user_id: str) -> bool:
+        return bool(await self.online([user_id]))
+
+    async def send_message(self, conn, body: dict, additional_data: Optional[dict] = {}):
+        data = json.dumps(body)
+        if body.get('action', '') == "authenticate" and body.get("success"):
             user_id = body.get("data", {}).get("user", {}).get("id", "")
             if user_id:
-                chats = db.chats.get_user_chats(user_id)
-                for chat in chats:
-                    user_to_notify = None
-                    if chat.user1 == user_id:
-                        user_to_notify = chat.user2
-                    elif chat.user2 == user_id:
-                        user_to_notify = chat.user1
-
-                    if user_to_notify:
-                        connections = await self.find_online_user(user_to_notify)
-                        for connection in connections:
-                            data = {
-                                "action": "status_change",
-                                "status": True,
-                                "data": {
-                                    "user_id": user_id,
-                                    "status": "online",
-                                    "last_seen": datetime.now().timestamp()
-                                }
-                            }
-                            data = json.dumps(data)
-                            try:
-                                if connection.is_open:
-                                    await connection.send(data)
-                            except Exception as e:
-                                print(e)
+                await self.notify_status(user_id, "online")
 
         elif body.get("action", '') == "delete_message" or body.get('action', '') == "edit_message": # because responses nearly same
             if additional_data:
                 other_user = additional_data.get("chat", {}).get("user")
                 if other_user:
-                    connections = await self.find_online_user(other_user)
-                    data = json.dumps(body)
-                    for connection in connections:
-                        await connection.send(data)
+                    await self.broadcast(self.registry.get(other_user), data)
 
         elif body.get('action', '') == "read_message":
             if additional_data:
                 users_to_notify = additional_data.get("users_to_notify", [])
-                for user_to_notify in users_to_notify:
-                    connections = await self.find_online_user(user_to_notify)
-                    data = json.dumps(body)
-                    for connection in connections:
-                        await connection.send(data)
+                await self.broadcast(self.connections_of(users_to_notify), data)
 
-        text = colored("[SENT]", "blue")
-        print(text, body)
-        print("--" * 30)
+        action = body.get("action")
+        if log.isEnabledFor(logging.DEBUG) and frames.keep(action):
+            log.debug("sent", extra={"fields": {"action": action, "user": conn.user and conn.user._id, "body": payload(body)}})
 
-        data = json.dumps(body)
         await conn.send(data)
 
-    async def find_online_user(self, id: str) -> List[Connection]:
-        return [connection for connection in self.client_list if connection.is_open and connection.user and str(connection.user._id) == id]
+    def connections_of(self, user_ids: Iterable[str]) -> List[Connection]:
+        return [conn for user_id in set(user_ids) for conn in self.registry.get(user_id)]
+
+    async def broadcast(self, connections: List[Connection], data: str, key: Optional[str] = None, ephemeral: bool = False) -> Tuple[int, int]:
+        """
+        Send an already encoded frame to all connections at once, a send that
+        errors or exceeds SEND_TIMEOUT only fails for that connection.
+        Returns (delivered, failed)
+        """
+        if not connections:
+            return 0, 0
+        results = await asyncio.gather(
+            *(asyncio.wait_for(conn.send(data, key=key, ephemeral=ephemeral), SEND_TIMEOUT) for conn in connections),
+            return_exceptions=True,
+        )
+        failed = sum(1 for result in results if isinstance(result, BaseException))
+        return len(results) - failed, failed
+
+    def outbound_stats(self) -> dict:
+        depths = [conn.queue_depth for conn in self.clients]
+        return {
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": sum(conn.dropped for conn in self.clients),
+            "coalesced": sum(conn.coalesced for conn in self.clients),
+        }
 
     async def handle_update(self, update: db.Update):
-        print(update.users)
-        for user in update.users:
-            online_user_conns = await self.find_online_user(user)
-            if online_user_conns:
-                data = {"action": update.type, "success": True, "data": update.body}
-                data = json.dumps(data)
-                for _conn in online_user_conns:
-                    if _conn.is_open:
-                        await _conn.send(data)
-
-    async def on_message(self, message: str, conn: Connection):
-        text = colored("[RECV]", "yellow")
-        print(text, message, "\n")
+        # one frame per recipient user, each carries that user's seq. The body
+        # is encoded once, only the small envelope around it is per user
+        started = time.perf_counter()
+        sends = []
+        prefix = None
+        for user in set(update.users):
+            connections = self.registry.get(user)
+            if connections:
+                if prefix is None:
+                    prefix = f'{{"action": {json.dumps(update.type)}, "success": true, "data": {json.dumps(update.body)}, "seq": '
+                data = f"{prefix}{json.dumps(update.seqs.get(user))}}}"
+                sends.append(self.broadcast(connections, data))
+        if sends:
+            results = await asyncio.gather(*sends)
+            delivered = sum(result[0] for result in results)
+            failed = sum(result[1] for result in results)
+            FANOUT_FRAMES.inc(delivered, "delivered")
+            FANOUT_FRAMES.inc(failed, "failed")
+            log.log(
+                logging.WARNING if failed else logging.DEBUG, "update",
+                extra={"fields": {"type": update.type, "delivered": delivered, "failed": failed}},
+            )
+        FANOUT_SECONDS.observe(time.perf_counter() - started, update.type)
+
+    def parse(self, message: str) -> Optional[Tuple[str, dict]]:
         try:
             data = json.loads(message)
-            if data.get("action"):
-                action = data.get("action")
-                if hasattr(actions, action):
-                    func = getattr(actions, action)
-                    data = data.get("data")
-                    response: actions.Response = func(data, conn)
-                    if response.send_now:
-                        body = {"action": action, "success": response.status, "data": response.data}
-                        await self.send_message(conn, body, response.additional_data)
-                else:
-                    print("[Aciton not found]", action)
         except json.JSONDecodeError:
-            print("invalid json")
+            log.info("invalid json", extra={"fields": {"frame": payload(message)}})
+            return None
+        if isinstance(data, dict) and data.get("action"):
+            if log.isEnabledFor(logging.DEBUG) and frames.keep(data.get("action")):
+                log.debug("recv", extra={"fields": {"action": data.get("action"), "data": payload(data.get("data"))}})
+            return data.get("action"), data.get("data")
+        return None
+
+    async def dispatch(self, action: str, data: dict, conn: Connection):
+        entry = action_table.get(action)
+        if entry is None:
+            ACTIONS.inc(1, "unknown", "unknown")
+            log.info("action not found", extra={"fields": {"action": payload(action)}})
+            return
+
+        # refused before the action runs, nothing here touches the database
+        retry_after = entry.throttle(conn.buckets)
+        if retry_after:
+            ACTIONS.inc(1, action, "throttled")
+            body = {"action": action, "success": False, "data": {"message": "Too many requests", "retry_after": round(retry_after, 3)}}
+            await self.send_message(conn, body)
+            return
+        if entry.busy:
+            ACTIONS.inc(1, action, "busy")
+            await self.send_message(conn, {"action": action, "success": False, "data": {"message": BusyException().message}})
+            return
+        data, errors = entry.validate(data)
+        if errors:
+            ACTIONS.inc(1, action, "invalid")
+            await self.send_message(conn, {"action": action, "success": False, "data": errors})
+            return
+
+        trace = profiler.begin(action)
+        started = time.perf_counter()
+        outcome = "error"
+        entry.inflight += 1
+        try:
+            response: actions.Response = await entry.handler(data, conn)
+            outcome = "ok" if response.status else "failed"
+            if response.send_now:
+                body = {"action": action, "success": response.status, "data": response.data}
+                await self.send_message(conn, body, response.additional_data)
         except Exception:
-            traceback.print_exc()
+            log.exception("action failed", extra={"fields": {"action": action}})
+        finally:
+            entry.inflight -= 1
+            elapsed = time.perf_counter() - started
+            ACTION_SECONDS.observe(elapsed, action)
+            ACTIONS.inc(1, action, outcome)
+            if trace:
+                user_id = str(conn.user._id) if conn.user else None
+                profiler.end(trace, elapsed, outcome, user_id, list(data))
 
     async def start(self):
-        cprint(f"Listening at {self.host}:{self.port}", "green")
-        async with websockets.serve(self.handler, self.host, self.port):
+        await self.bus.start()
+        if db.user_search_index is not None:
+            log.info(f"Search index holds {await db.users.load_search_index()} users")
+        if self.metrics_port:
+            await metrics.serve(METRICS_HOST, self.metrics_port)
+            log.info(f"Metrics at http://{METRICS_HOST}:{self.metrics_port}/metrics")
+        log.info(f"Listening at {self.host}:{self.port}")
+        async with websockets.serve(self.handler, self.host, self.port, reuse_port=self.reuse_port):
             await asyncio.Future()
 
 
-if __name__ == "__main__":
-    server = Server(BIND_HOST, BIND_PORT)
+def run_worker(reuse_port: bool = False, index: int = 0):
+    setup_logging()
+    # each worker gets its own metrics port, counting up from METRICS_PORT
+    server = Server(BIND_HOST, BIND_PORT, reuse_port=reuse_port, metrics_port=METRICS_PORT + index if METRICS_PORT else 0)
     use_server(server)
     asyncio.run(server.start())
+
+
+if __name__ == "__main__":
+    setup_logging()
+    split = migrate_updates()
+    if split:
+        log.info(f"split {split} updates into per-user logs")
+    for name in ensure_indexes():
+        log.info(f"created index {name}")
+    backfilled = backfill_search_keys()
+    if backfilled:
+        log.info(f"set search_keys on {backfilled} users")
+
+    if WORKERS > 1:
+        if UPDATE_BUS != "redis":
+            raise SystemExit("WORKERS > 1 needs UPDATE_BUS=redis so workers see each other's updates")
+        # spawn, the parent's MongoClient must not be forked into the workers
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=run_worker, args=(True, index)) for index in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker()
@@ -1,8 +1,10 @@
+import asyncio
+
 from lib import db
 from datetime import datetime, timedelta
 from getpass import getpass
 
-def seed_chat():
+async def seed_chat():
     """
     Seeds the database with a sample conversation between two users.
     """
@@ -12,25 +14,25 @@ def seed_chat():
     user1_username = "test"
     user2_username = "user1"
 
-    user1 = db.users.get(username=user1_username)
-    user2 = db.users.get(username=user2_username)
+    user1 = await db.users.get(username=user1_username)
+    user2 = await db.users.get(username=user2_username)
 
     if not user1:
         print(f"User '{user1_username}' not found.")
         password = getpass(f"Enter password for new user '{user1_username}': ")
-        user1 = db.users.create(db.User(username=user1_username, email=f"{user1_username}@example.com", password=password))
+        user1 = await db.users.create(db.User(username=user1_username, email=f"{user1_username}@example.com", password=password))
         print(f"Created user '{user1_username}'")
 
     if not user2:
         print(f"User '{user2_username}' not found.")
         password = getpass(f"Enter password for new user '{user2_username}': ")
-        user2 = db.users.create(db.User(username=user2_username, email=f"{user2_username}@example.com", password=password))
+        user2 = await db.users.create(db.User(username=user2_username, email=f"{user2_username}@example.com", password=password))
         print(f"Created user '{user2_username}'")
 
     # 2. Get or create chat
-    chat = db.chats.check_exists(user1._id, user2._id)
+    chat = await db.chats.check_exists(user1._id, user2._id)
     if not chat:
-        chat = db.chats.create(db.Chat(user1=str(user1._id), user2=str(user2._id)))
+        chat = await db.chats.create(db.Chat(user1=str(user1._id), user2=str(user2._id)))
         print(f"Created chat between {user1.username} and {user2.username}")
     
     chat_id = str(chat._id)
@@ -110,9 +112,9 @@ def seed_chat():
             text=msg_data["text"],
             time=now - timedelta(minutes=len(messages_to_insert) - i)
         )
-        db.messages.create(message)
+        await db.messages.create(message)
 
     print(f"Inserted {len(messages_to_insert)} messages into chat {chat_id}")
 
 if __name__ == "__main__":
-    seed_chat()
+    asyncio.run(seed_chat())
@@ -1,25 +1,102 @@
+import asyncio
+import hashlib
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import bcrypt
 import jwt
 
-from conf import SECRET_KEY
-from lib.db import User
+from conf import BCRYPT_ROUNDS, CRYPT_MAX_PENDING, CRYPT_WORKERS, SECRET_KEY, TOKEN_CACHE_SIZE
+from utils.exceptions import BusyException
+
+if TYPE_CHECKING:
+    from lib.db import User
 
 ALGORITHM = "HS256"
 EXP_MINUTES = 60
 
+_pool: Optional[ProcessPoolExecutor] = None
+# sha256 of a verified token -> its payload, dropped once past exp, least recently used first
+_verified: "OrderedDict[bytes, dict]" = OrderedDict()
+crypt_stats = {"pending": 0, "completed": 0, "rejected": 0, "pool_restarts": 0, "queue_time_total": 0.0, "queue_time_max": 0.0}
+
 
 def hash_password(plain_password: str) -> str:
-    return bcrypt.hashpw(plain_password.encode(), bcrypt.gensalt()).decode()
+    return bcrypt.hashpw(plain_password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
 
 def check_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
 
-def create_tokens(user: User) -> dict:
+def _timed(func, *args):
+    started = time.time()
+    return func(*args), started
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(CRYPT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _replace_pool(broken: ProcessPoolExecutor) -> None:
+    # other calls that failed with the same pool must not replace its successor
+    global _pool
+    if _pool is broken:
+        _pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        crypt_stats["pool_restarts"] += 1
+
+
+async def _run_in_pool(func, *args):
+    """
+    Run a bcrypt call in the crypt process pool. Past CRYPT_MAX_PENDING
+    queued calls new ones are refused, so a login storm can't grow the queue.
+    A pool broken by a dead worker is replaced and the call retried once
+    """
+    if crypt_stats["pending"] >= CRYPT_MAX_PENDING:
+        crypt_stats["rejected"] += 1
+        raise BusyException()
+
+    crypt_stats["pending"] += 1
+    submitted = time.time()
+    try:
+        for attempt in range(2):
+            pool = _get_pool()
+            try:
+                result, started = await asyncio.get_running_loop().run_in_executor(pool, _timed, func, *args)
+                break
+            except BrokenProcessPool:
+                _replace_pool(pool)
+                if attempt:
+                    raise BusyException()
+    finally:
+        crypt_stats["pending"] -= 1
+
+    # time between submitting and a worker picking the call up
+    waited = started - submitted
+    crypt_stats["completed"] += 1
+    crypt_stats["queue_time_total"] += waited
+    crypt_stats["queue_time_max"] = max(crypt_stats["queue_time_max"], waited)
+    return result
+
+
+async def hash_password_async(plain_password: str) -> str:
+    return await _run_in_pool(hash_password, plain_password)
+
+
+async def check_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_in_pool(check_password, plain_password, hashed_password)
+
+
+def create_tokens(user: "User") -> dict:
     access_payload = {"sub": str(user._id), "exp": datetime.utcnow() + timedelta(minutes=15), "type": "access"}
     refresh_payload = {"sub": str(user._id), "exp": datetime.utcnow() + timedelta(days=7), "type": "refresh"}
     access_token = jwt.encode(access_payload, SECRET_KEY, algorithm=ALGORITHM)
@@ -27,31 +104,61 @@ def create_tokens(user: User) -> dict:
     return {"access": access_token, "refresh": refresh_token}
 
 
-def refresh_access_token(refresh_token: str) -> Optional[str]:
-    try:
-        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
-        if payload.get("type") != "refresh":
+def _verify(token: str, token_type: str) -> Optional[dict]:
+    """
+    Decode and verify a token, reusing the payload of a token verified
+    before until it expires
+    """
+    if not token:
+        return None
+    key = hashlib.sha256(token.encode()).digest()
+    payload = _verified.get(key)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.ExpiredSignatureError:
             return None
-        new_payload = {"sub": payload["sub"], "exp": datetime.utcnow() + timedelta(minutes=15), "type": "access"}
-        return jwt.encode(new_payload, SECRET_KEY, algorithm=ALGORITHM)
-    except jwt.ExpiredSignatureError:
+        except jwt.InvalidTokenError:
+            return None
+        if len(_verified) >= TOKEN_CACHE_SIZE:
+            _evict()
+        _verified[key] = payload
+    else:
+        _verified.move_to_end(key)
+
+    if time.time() >= payload.get("exp", 0):
+        _verified.pop(key, None)
         return None
-    except jwt.InvalidTokenError:
+    if payload.get("type") != token_type:
+        return None
+    return payload
+
+
+def _evict():
+    # only ever looks at the front: expired entries there, then the least
+    # recently used until there is room. Expired ones elsewhere go on lookup
+    now = time.time()
+    while _verified and (len(_verified) >= TOKEN_CACHE_SIZE or now >= next(iter(_verified.values())).get("exp", 0)):
+        _verified.popitem(last=False)
+
+
+def validate_refresh_token(refresh_token: str) -> Optional[dict]:
+    """
+    Validate refresh token and return payload if valid, without minting anything
+    """
+    return _verify(refresh_token, "refresh")
+
+
+def refresh_access_token(refresh_token: str) -> Optional[str]:
+    payload = validate_refresh_token(refresh_token)
+    if not payload:
         return None
+    new_payload = {"sub": payload["sub"], "exp": datetime.utcnow() + timedelta(minutes=15), "type": "access"}
+    return jwt.encode(new_payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
 def validate_access_token(token: str) -> Optional[dict]:
     """
     Validate access token and return payload if valid
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        if payload.get("type") != "access":
-            return None
-        if datetime.utcnow().timestamp() > payload.get("exp", 0):
-            return None
-        return payload
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
-        return None
+    return _verify(token, "access")
@@ -2,3 +2,23 @@ class UnauthorizedException(Exception):
     def __init__(self, message="Unauthorized"):
         self.message = message
         super().__init__(self.message)
+
+
+class SlowConsumerException(Exception):
+    def __init__(self, message="Outbound queue is full"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class BusyException(Exception):
+    def __init__(self, message="Server is busy, please try again"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class CommitException(Exception):
+    def __init__(self, message="Message could not be saved, please try again", stored=False):
+        # stored: the message is in the db but its updates were not written, resending would duplicate it
+        self.message = message
+        self.stored = stored
+        super().__init__(self.message)
@@ -0,0 +1,87 @@
+from dataclasses import replace
+from typing import Dict, List, Optional
+
+from lib import db
+from utils.server_holder import online_users
+
+# how many levels of reply_to a serialized message quotes
+REPLY_DEPTH = 1
+
+
+async def serialize_chats(chats: List[db.Chat], user: db.User) -> List[Dict]:
+    """
+    Serialize a chat list for `user`, loading every counterpart with one query
+    and marking who is online
+    """
+    other_ids = {str(chat.other_user_id(user._id)) for chat in chats}
+    users = await db.users.get_many(other_ids)
+    online = await online_users(other_ids)
+
+    results = []
+    for chat in chats:
+        other_user_id = str(chat.other_user_id(user._id))
+        data = await chat.serialize(user, other_user=users.get(other_user_id, user))
+        data["user"]["is_online"] = other_user_id in online
+        results.append(data)
+    return results
+
+
+async def serialize_messages(messages: List[db.Message], user: Optional[db.User] = None, depth: int = REPLY_DEPTH) -> List[Dict]:
+    """
+    Serialize a page of messages, resolving reply targets for the whole page
+    with one query per quoted level
+    """
+    replies: Dict[str, db.Message] = {str(message._id): message for message in messages}
+    targets = list(messages)
+    for _ in range(depth):
+        pending = {str(message.reply_to) for message in targets if message.reply_to} - replies.keys()
+        if not pending:
+            break
+        found = await db.messages.get_many(pending)
+        replies.update(found)
+        targets = list(found.values())
+
+    return [message.serialize(user=user, replies=replies, depth=depth) for message in messages]
+
+
+def compact_updates(updates: List[db.Update]) -> List[db.Update]:
+    """
+    Collapse updates superseded later in the same page: an edit folds into
+    the new_message or an earlier edit of the same message, a delete removes
+    them, a message both created and deleted within the page disappears and
+    only the latest read watermark of a chat is kept
+    """
+    compacted: List[Optional[db.Update]] = []
+    created: Dict[str, int] = {}
+    edited: Dict[str, int] = {}
+    read_until: Dict[str, int] = {}
+    for update in updates:
+        if update.type == "read_message" and update.body.get("up_to"):
+            # a later watermark for the same chat covers an earlier one
+            chat_id = update.body.get("chat_id")
+            if chat_id in read_until:
+                compacted[read_until[chat_id]] = None
+            read_until[chat_id] = len(compacted)
+        elif update.type == "new_message":
+            message_id = update.body.get("message", {}).get("id")
+            created[message_id] = len(compacted)
+        elif update.type == "edit_message":
+            message_id = update.body.get("message_id")
+            if message_id in created:
+                position = created[message_id]
+                new_message = compacted[position]
+                body = {**new_message.body, "message": {**new_message.body["message"], "text": update.body.get("text")}}
+                compacted[position] = replace(new_message, body=body)
+                continue
+            if message_id in edited:
+                compacted[edited[message_id]] = None
+            edited[message_id] = len(compacted)
+        elif update.type == "delete_message":
+            message_id = update.body.get("message_id")
+            if message_id in edited:
+                compacted[edited.pop(message_id)] = None
+            if message_id in created:
+                compacted[created.pop(message_id)] = None
+                continue
+        compacted.append(update)
+    return [update for update in compacted if update is not None]
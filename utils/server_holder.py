@@ -1,6 +1,16 @@
 import asyncio
+from typing import Iterable, Set
+
+from lib.log import get_logger
+from lib.metrics import metrics
+
+log = get_logger("server")
+
+PUBLISH_FAILURES = metrics.counter("chat_publish_failures_total", "Updates the bus failed to publish, they are still in the update log")
 
 _server = None
+# publishes in flight, referenced until done so they aren't garbage collected
+_publishing: Set[asyncio.Task] = set()
 
 
 def use_server(s):
@@ -9,4 +19,19 @@ def use_server(s):
 
 def handle_update(update):
     if _server:
-        asyncio.create_task(_server.handle_update(update))
+        task = asyncio.create_task(_server.bus.publish(update))
+        _publishing.add(task)
+        task.add_done_callback(_published)
+
+
+def _published(task: asyncio.Task) -> None:
+    _publishing.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        PUBLISH_FAILURES.inc()
+        log.error("update publish failed", exc_info=task.exception())
+
+
+async def online_users(user_ids: Iterable[str]) -> Set[str]:
+    if _server:
+        return await _server.online(user_ids)
+    return set()